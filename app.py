@@ -1,90 +1,504 @@
+import io
 import os
-from flask import Flask, render_template, redirect, url_for, session, flash
+import gzip
+import time
+import shutil
+import logging
+import tempfile
+from datetime import datetime
+from flask import Flask, render_template, redirect, url_for, flash, abort, Response, jsonify, request
 from flask_bootstrap import Bootstrap, bootstrap_find_resource
 from flask_moment import Moment
 from flask_wtf import Form
-from wtforms import DateField, StringField, SubmitField
-from flask_wtf.file import FileField, FileAllowed, FileRequired
+from wtforms import DateField, StringField, SubmitField, BooleanField
+from flask_wtf.file import FileField, FileAllowed
+from werkzeug.datastructures import FileStorage
 from wtforms.validators import DataRequired #, Regexp
-from flask_weasyprint import HTML, render_pdf, CSS
 
-from bpw_graphs import dashboard
+import bpw_charts
+import bpw_metrics
+import bpw_tasks
+from bpw_metrics import timed
+from bpw_schema import EXPORTS, ExportError, validate_exports
+from bpw_cache import DashboardCache, cached_dashboard
+from bpw_jobs import JobQueue, DONE, FAILED, LOST
+from bpw_store import ResultStore
+from bpw_pdf import PdfRenderer, PdfUnavailable
 
 app = Flask(__name__)
 app.config.from_object(os.environ['APP_SETTINGS'])
+bpw_charts.configure(app.config['CHART_BACKEND'], app.config['CHART_DIR'])
+bpw_metrics.configure(app.config['METRICS_ENABLED'])
+bpw_tasks.configure(app.config['DASHBOARD_THREADS'], app.config['CHART_PROCESSES'])
+if app.config['METRICS_ENABLED'] and not bpw_metrics.logger.handlers:
+    bpw_metrics.logger.addHandler(logging.StreamHandler())
+    bpw_metrics.logger.setLevel(logging.INFO)
+cache = DashboardCache(app.config['CACHE_DIR'], app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_TTL'],
+                       app.config['CACHE_MAX_DISK_ENTRIES'])
+jobs = JobQueue(app.config['JOB_DIR'], app.config['JOB_WORKERS'])
+results = ResultStore(app.config['RESULT_DB'], app.config['RESULT_TTL'])
+pdfs = PdfRenderer(app.config['PDF_DIR'], app.config['CHART_DIR'], app.static_folder, app.config['PDF_WORKERS'],
+                   app.config['RESULT_TTL'], app.config['PDF_TIMEOUT'])
 
 bootstrap = Bootstrap(app)
 moment = Moment(app)
 
+# bpw_graphs and the stores below bring in pandas, numpy and plotly, which take
+# most of the time a worker needs to start.  They are imported on first use, so
+# a worker serves the upload form right away; with gunicorn_config.py they are
+# loaded once in the master instead and shared by the workers after the fork.
+_stores = {}
+
+
+def get_aggregates():
+    if 'aggregates' not in _stores:
+        from bpw_incremental import AggregateStore
+        _stores['aggregates'] = AggregateStore(app.config['INCREMENTAL_DB'])
+    return _stores['aggregates']
+
+
+def get_cost_index():
+    if 'cost_index' not in _stores:
+        from bpw_index import CostIndex
+        _stores['cost_index'] = CostIndex(app.config['COST_INDEX_DB'])
+    return _stores['cost_index']
+
+
+def get_columns():
+    if 'columns' not in _stores:
+        from bpw_columns import ColumnStore
+        _stores['columns'] = ColumnStore(app.config['COLUMN_DIR'])
+    return _stores['columns']
+
+
+def preload():
+    '''
+    Imports everything a dashboard and its PDF need, for the gunicorn master to call before it forks
+    '''
+    import bpw_graphs
+    import bpw_pdf
+    # The PDF workers are forked from the web workers and start with all of it
+    bpw_pdf.warm_up()
+    get_aggregates()
+    get_cost_index()
+    # Hashes the cleaning code once instead of in every worker
+    get_columns().version
+
 class UploadForm(Form):
     client = StringField('Client Name', validators = [DataRequired()])
     start = DateField('Start Date for Dashboard (mm/dd/YYYY)', validators=[DataRequired()], format= "%m/%d/%Y")
     #end = DateField('End Date for Dashboard (Optional)', validators=[Optional()], format="%m-%d-%Y")
     roofs = FileField('Roof_Condition_Export file', validators=[
-        FileRequired(),
         FileAllowed(['csv'], 'CSV Files Only!')
     ])
     worders = FileField('Work_Order_Export file', validators=[
-        FileRequired(),
         FileAllowed(['csv'], 'CSV Files Only!')
     ])
     projects = FileField('Custom_Project_Export file', validators=[
-        FileRequired(),
         FileAllowed(['csv'], 'CSV Files Only!')
     ])
     receivables = FileField('Custom_Accounts_Receivable_Export file', validators=[
-        FileRequired(),
         FileAllowed(['csv'], 'CSV Files Only!')
     ])
+    incremental = BooleanField('The files only have the rows added or changed since the last dashboard '
+                               'of this client and start date')
     submit = SubmitField('PRESS TO CREATE DASHBOARD')
 
+    def export_fields(self):
+        return [self.roofs, self.worders, self.projects, self.receivables]
+
+    def validate(self, *args, **kwargs):
+        # All four files are required, except for an incremental dashboard where
+        # the exports without changes can be left out
+        if not Form.validate(self, *args, **kwargs):
+            return False
+        missing = [field for field in self.export_fields() if not has_file(field.data)]
+        if self.incremental.data and len(missing) < len(EXPORTS):
+            return True
+        if self.incremental.data:
+            missing = missing[:1]
+            message = 'Upload at least one file with the new or changed rows'
+        else:
+            message = 'This field is required.'
+        for field in missing:
+            field.errors.append(message)
+        return not missing
+
+
+def has_file(upload):
+    return isinstance(upload, FileStorage) and bool(upload.filename)
+
+
+def upload_paths(upload_dir):
+    return [os.path.join(upload_dir, name + '.csv') for name in EXPORTS]
+
+
+def save_uploads(uploads):
+    '''
+    :param uploads: the four uploaded files in the order of bpw_schema.EXPORTS, None for one left out
+    :return: a new directory in UPLOAD_DIR with the uploads, see upload_paths and uploaded_paths
+    '''
+    upload_root = app.config['UPLOAD_DIR']
+    if not os.path.isdir(upload_root):
+        try:
+            os.makedirs(upload_root)
+        except OSError:
+            if not os.path.isdir(upload_root):
+                raise
+    # Uploads of jobs that never ran, like those queued when a worker restarted
+    for name in os.listdir(upload_root):
+        path = os.path.join(upload_root, name)
+        try:
+            if time.time() - os.path.getmtime(path) >= app.config['UPLOAD_TTL']:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+    upload_dir = tempfile.mkdtemp(dir=upload_root)
+    for upload, path in zip(uploads, upload_paths(upload_dir)):
+        # Copied a block at a time, Werkzeug already spooled the large ones to a temporary file
+        if upload is not None:
+            upload.save(path)
+    return upload_dir
+
+
+def uploaded_paths(upload_dir):
+    '''
+    :return: a dictionary with the path of each export that was uploaded to upload_dir
+    '''
+    return dict((name, path) for name, path in zip(EXPORTS, upload_paths(upload_dir)) if os.path.exists(path))
+
+
+def build_dashboard(upload_dir, start_date, client_name, incremental=False):
+    '''
+    Runs on the job queue: computes the dashboard, starts its PDF and returns the id it is stored under
+    '''
+    from bpw_graphs import dashboard, cost_comparison, DASH_FIELDS, CHART_FIELDS
+
+    cost_index = get_cost_index()
+    try:
+        roofs, worders, projects, receivables = paths = upload_paths(upload_dir)
+        if incremental:
+            # Exports left out of the upload are unchanged
+            uploaded = uploaded_paths(upload_dir)
+            dash_list = dashboard(*([uploaded.get(name) for name in EXPORTS] + [start_date, get_aggregates()]),
+                                  client_name=client_name, cost_index=cost_index)
+        elif sum(os.path.getsize(path) for path in paths) > app.config['CHUNKED_MIN_BYTES']:
+            # Large uploads are aggregated a chunk at a time to keep the memory flat
+            dash_list = cached_dashboard(cache, roofs, worders, projects, receivables, start_date,
+                                         app.config['CHART_BACKEND'], client_name=client_name,
+                                         chunksize=app.config['CHUNK_ROWS'], cost_index=cost_index)
+        else:
+            # A hit puts the client in the cost index as well, see cached_dashboard
+            dash_list = cached_dashboard(cache, roofs, worders, projects, receivables, start_date,
+                                         app.config['CHART_BACKEND'], client_name=client_name,
+                                         columns=get_columns(), cost_index=cost_index)
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+    # Not cached, the other clients change
+    dash_list = dash_list + [cost_comparison(cost_index, client_name)]
+    result_id = results.put(dash_list, client_name, start_date)
+    # A cached dashboard can reuse charts for as long as they are kept as well
+    bpw_charts.keep_charts([ref for name, ref in zip(DASH_FIELDS, dash_list) if name in CHART_FIELDS])
+    bpw_charts.prune_charts(max(app.config['RESULT_TTL'], app.config['CACHE_TTL']))
+    with app.test_request_context():
+        pdfs.submit(result_id, *pdf_html(dict(dash_list=dash_list, start_date=start_date,
+                                              client_name=client_name)))
+    return result_id
+
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     form = UploadForm()
     if form.validate_on_submit():
-        roofs = form.roofs.data.stream
-        worders = form.worders.data.stream
-        projects = form.projects.data.stream
-        receivables = form.receivables.data.stream
-        start_date = form.start.data.strftime('%m/%d/%Y')
+        # The upload streams are closed once the request ends, so the job gets copies on disk
+        upload_dir = save_uploads([field.data if has_file(field.data) else None for field in form.export_fields()])
         try:
-            dash_list = dashboard(roofs, worders, projects,receivables, start_date)
-        except:
-            flash('One or more of the CSV files is the wrong file')
-            return redirect(url_for('index'))
+            validate_exports(uploaded_paths(upload_dir), with_key=form.incremental.data)
+        except ExportError as error:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            flash(str(error))
+            return render_template("index.html", form = form)
+        start_date = form.start.data.strftime('%m/%d/%Y')
         client_name = form.client.data
         form.client.data = ''
-        session['client_name'] = client_name
-        session['dash_list'] = dash_list
-        session['start_date'] = start_date
-        return redirect(url_for('dash'))
+        job_id = jobs.submit(build_dashboard, upload_dir, start_date, client_name, form.incremental.data,
+                             client_name=client_name, start_date=start_date)
+        return redirect(url_for('job_status', job_id=job_id))
     return render_template("index.html", form = form)
 
 
-@app.route('/dashboard')
-def dash():
-    dash_list = session.get('dash_list')
-    start_date = session.get('start_date')
-    client_name = session.get('client_name')
-    return render_template('dashboard.html', dash_list = dash_list, start_date = start_date,
-                           client_name = client_name)
-
-@app.route('/dashboard.pdf')
-def dash_pdf():
-    dash_list = session.get('dash_list')
-    start_date = session.get('start_date')
-    client_name = session.get('client_name')
-    html = render_template('dashboard_pdf.html', dash_list = dash_list, start_date = start_date,
-                           client_name = client_name)
-    return render_pdf(HTML(string=html),stylesheets=[
-                                                     CSS(string='@page { size: A3 portrait;'
-                                                                'background-color: #f8f8ff ;'
-                                                                ' margin: 2cm };'
-                                                                '* { float: none !important; };'
-                                                                '@media print { nav { display: none; }'
-                                                                '.piechart{width:200px; }')
-                                                     ])
+@app.errorhandler(413)
+def upload_too_large(error):
+    if request.path.startswith('/api/'):
+        return jsonify(error='The files are larger than the upload limit'), 413
+    flash('The files are larger than the upload limit of {:,.0f} MB'.format(app.config['MAX_CONTENT_LENGTH'] / 1e6))
+    return redirect(url_for('index'))
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.status(job_id)
+    if job is None:
+        abort(404)
+    if job['state'] == FAILED:
+        if job.get('error_type') in ('ExportError', LOST):
+            flash(job['error'])
+        else:
+            flash('One or more of the CSV files is the wrong file')
+        return redirect(url_for('index'))
+    if job['state'] == DONE:
+        return redirect(url_for('dash', result_id=job['result']))
+    return render_template('job.html', job_id=job_id, job=job)
+
+
+@app.route('/jobs/<job_id>.json')
+def job_status_json(job_id):
+    job = jobs.status(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(state=job['state'], error=job.get('error'))
+
+
+@app.template_global()
+def chart_embed_url(ref, width, height):
+    if bpw_charts.is_local(ref):
+        return url_for('chart_embed', chart_id=ref)
+    return '{}.embed?width={}&height={}'.format(ref, width, height)
+
+
+@app.template_global()
+def chart_image_url(ref, external=False):
+    if bpw_charts.is_local(ref):
+        return url_for('chart_svg', chart_id=ref, _external=external)
+    return ref + '.png'
+
+
+def load_chart(chart_id):
+    try:
+        return bpw_charts.load_figure(chart_id)
+    except KeyError:
+        abort(404)
+
+
+@app.route('/charts/plotly.js')
+def plotly_js():
+    response = Response(bpw_charts.plotly_js(), mimetype='application/javascript')
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
+
+
+@app.route('/charts/<chart_id>.embed')
+def chart_embed(chart_id):
+    return render_template('chart.html', chart_div=bpw_charts.figure_div(load_chart(chart_id)))
+
+
+@app.route('/charts/<chart_id>.svg')
+def chart_svg(chart_id):
+    # Charts are content addressed, so they never change once written
+    response = Response(bpw_charts.figure_svg(load_chart(chart_id)), mimetype='image/svg+xml')
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
+
+
+def load_result(result_id):
+    result = results.get(result_id)
+    if result is None:
+        abort(404)
+    return result
+
+
+@app.route('/dashboard/<result_id>')
+def dash(result_id):
+    result = load_result(result_id)
+    with timed('render_template:dashboard'):
+        return render_template('dashboard.html', result_id = result_id, dash_list = result['dash_list'],
+                               start_date = result['start_date'], client_name = result['client_name'])
+
+def pdf_html(result):
+    '''
+    :param result: a dashboard from the result store
+    :return: the HTML of its PDF and the URL its links are relative to
+    '''
+    with timed('render_template:dashboard_pdf'):
+        html = render_template('dashboard_pdf.html', dash_list = result['dash_list'],
+                               start_date = result['start_date'], client_name = result['client_name'])
+    return html, request.url_root
+
+
+# Seconds a client is asked to wait for a PDF that isn't ready
+PDF_RETRY_SECONDS = 10
+
+
+@app.route('/dashboard/<result_id>.pdf')
+def dash_pdf(result_id):
+    # Usually rendered in the background when the dashboard was computed
+    try:
+        pdf = pdfs.get(result_id)
+        if pdf is None:
+            result = load_result(result_id)
+            pdf = pdfs.get(result_id, lambda: pdf_html(result))
+    except PdfUnavailable as error:
+        response = Response(str(error), status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(PDF_RETRY_SECONDS)
+        return response
+    return Response(pdf, mimetype='application/pdf')
+
+
+# Bump this when the fields of the API change, it is part of the ETags
+API_VERSION = '2'
+
+# Smaller responses aren't worth compressing
+GZIP_MIN_BYTES = 1024
+
+
+def api_dashboard_response(result_id):
+    '''
+    :param result_id: the id of a stored dashboard
+    :return: the dashboard as JSON with named fields, 304 when the client has it already
+    '''
+    from bpw_graphs import DASH_FIELDS, CHART_FIELDS
+
+    charts = request.args.get('charts', '1') != '0'
+    # Looked up first, so a dashboard that expired isn't answered with a 304
+    result = results.get(result_id)
+    if result is None:
+        return jsonify(error='No dashboard {}'.format(result_id)), 404
+    # Stored dashboards never change, so the id is enough for the ETag
+    etag = '{}-{}{}'.format(result_id, API_VERSION, '' if charts else '-nocharts')
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    last_modified = datetime.utcfromtimestamp(int(result['created']))
+    if request.if_modified_since is not None and request.if_modified_since.replace(tzinfo=None) >= last_modified:
+        return not_modified(etag)
+
+    fields = dict(zip(DASH_FIELDS, result['dash_list']))
+    # The metrics as the dashboard shows them, and the numbers they are made of
+    numbers = fields.pop('numbers', None)
+    payload = dict(id=result_id, client_name=result['client_name'], start_date=result['start_date'],
+                   created=result['created'], metrics=dict((name, value) for name, value in fields.items()
+                                                           if name not in CHART_FIELDS), numbers=numbers)
+    payload['charts'] = {}
+    for name in CHART_FIELDS:
+        ref = fields.get(name)
+        if ref is None:
+            continue
+        chart = dict(ref=ref, image_url=chart_image_url(ref, external=True))
+        if charts and bpw_charts.is_local(ref):
+            try:
+                chart['figure'] = bpw_charts.load_figure(ref)
+            except KeyError:
+                chart['figure'] = None
+        payload['charts'][name] = chart
+
+    response = jsonify(**payload)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    if 'gzip' in request.accept_encodings and len(response.get_data()) > GZIP_MIN_BYTES:
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6) as compressed:
+            compressed.write(response.get_data())
+        response.set_data(buffer.getvalue())
+        response.content_encoding = 'gzip'
+    return response
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/api/dashboard', methods=['POST'])
+def api_create_dashboard():
+    '''
+    Builds a dashboard from the four exports, posted as the files roofs, worders, projects and
+    receivables with the form fields client_name and start_date (mm/dd/YYYY).  The dashboard is
+    built on the job queue: the answer is a 202 with the job to poll in its Location, see api_job
+    '''
+    missing = [name for name in EXPORTS if name not in request.files]
+    if missing:
+        return jsonify(error='Missing files: {}'.format(', '.join(missing))), 400
+    client_name = request.form.get('client_name', '').strip()
+    if not client_name:
+        return jsonify(error='Missing client_name'), 400
+    try:
+        start_date = datetime.strptime(request.form.get('start_date', ''), '%m/%d/%Y').strftime('%m/%d/%Y')
+    except ValueError:
+        return jsonify(error='start_date must be mm/dd/YYYY'), 400
+
+    upload_dir = save_uploads([request.files[name] for name in EXPORTS])
+    try:
+        validate_exports(dict(zip(EXPORTS, upload_paths(upload_dir))))
+    except (ExportError, ValueError) as error:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return jsonify(error=str(error)), 400
+    job_id = jobs.submit(build_dashboard, upload_dir, start_date, client_name,
+                         client_name=client_name, start_date=start_date)
+    response = api_job_response(job_id, jobs.status(job_id))
+    response.status_code = 202
+    return response
+
+
+# Errors of a failed job whose message is shown as is: those about the uploaded
+# files, and jobs lost with their worker
+SHOWN_ERRORS = ['ExportError', 'ValueError', LOST]
+
+# Seconds a client is asked to wait before polling a job again
+JOB_POLL_SECONDS = 2
+
+
+def api_job_response(job_id, job):
+    '''
+    :param job_id: a job id from jobs.submit
+    :param job: its status
+    :return: the state of the job as JSON, with the job in the Location
+    '''
+    payload = dict(id=job_id, state=job['state'])
+    if job['state'] == FAILED:
+        if job.get('error_type') in SHOWN_ERRORS:
+            payload['error'] = job['error']
+        else:
+            payload['error'] = 'The dashboard could not be built'
+    response = jsonify(**payload)
+    response.headers['Location'] = url_for('api_job', job_id=job_id, _external=True)
+    if job['state'] != FAILED:
+        response.headers['Retry-After'] = str(JOB_POLL_SECONDS)
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    '''
+    The state of a dashboard posted to api_create_dashboard; once it is built, a 303 to the dashboard
+    '''
+    job = jobs.status(job_id)
+    if job is None:
+        return jsonify(error='No job {}'.format(job_id)), 404
+    if job['state'] == DONE:
+        response = redirect(url_for('api_dashboard', result_id=job['result'], _external=True), code=303)
+        response.cache_control.no_store = True
+        return response
+    return api_job_response(job_id, job)
+
+
+@app.route('/api/dashboard/<result_id>')
+def api_dashboard(result_id):
+    return api_dashboard_response(result_id)
+
+
+@app.route('/metrics')
+def metrics():
+    if not bpw_metrics.enabled():
+        abort(404)
+    return Response(bpw_metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
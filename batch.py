@@ -0,0 +1,290 @@
+"""
+Builds the dashboards of many clients at once, without the upload form.
+
+    python batch.py CLIENTS_DIR OUT_DIR --start 01/01/2016
+    python batch.py manifest.csv OUT_DIR
+    python batch.py CLIENTS_DIR OUT_DIR --combined all.pdf
+    python batch.py CLIENTS_DIR OUT_DIR --cost-index batch_index.db
+
+CLIENTS_DIR holds one directory per client, named after the client, with the
+four exports under their Dataforma names (Roof_Condition_Export.csv, ...).  A
+manifest is a CSV file with the columns client, start_date and optionally
+path, the directory of that client's exports relative to the manifest; without
+a path the directory is named after the client.
+
+Each client gets OUT_DIR/<client>/dashboard.html and dashboard.pdf, made with
+the templates of the app, next to the SVGs of its charts.  The dashboards are
+computed on a pool of processes, one per core by default.  The projects of
+all the clients are put in the cost index before any dashboard is built, so
+each one is compared with every other client whatever the order they finish
+in; a client whose projects are in the index already is left as it is.  The
+index is the one of the app (BPW_COST_INDEX_DB) unless --cost-index names
+another.  A client whose exports, start date and comparison with the others
+haven't changed since its last successful run is skipped, so an interrupted
+batch can simply be run again.  Failed clients are listed in OUT_DIR/errors.csv
+and make the exit status 1.  With --combined the dashboards of all the clients
+that built are also laid out in one pass into a single PDF.
+"""
+import os
+import io
+import re
+import csv
+import sys
+import json
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+from timeit import default_timer
+
+from bpw_cache import DashboardCache, update_digest
+from bpw_schema import EXPORTS, ExportError, validate_exports
+
+STAMP = '.dashboard.json'
+OUTPUTS = ['dashboard.html', 'dashboard.pdf']
+
+# Skipped clients are ones that are up to date
+OK = 'ok'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def export_paths(directory):
+    return [os.path.join(directory, EXPORTS[name]['title'] + '.csv') for name in EXPORTS]
+
+
+def read_clients(source, start_date=None):
+    '''
+    :param source: a directory of client directories or a manifest CSV file
+    :param start_date: start date of the clients without one in the manifest
+    :return: a list of (client name, start date, export directory)
+    '''
+    if os.path.isdir(source):
+        return [(name, start_date, os.path.join(source, name)) for name in sorted(os.listdir(source))
+                if os.path.isdir(os.path.join(source, name))]
+
+    base = os.path.dirname(os.path.abspath(source))
+    clients = []
+    with open(source) as manifest:
+        for row in csv.DictReader(manifest):
+            clients.append((row['client'], row.get('start_date') or start_date,
+                            os.path.join(base, row.get('path') or row['client'])))
+    return clients
+
+
+def client_dir(out_dir, client_name):
+    return os.path.join(out_dir, re.sub(r'[^\w.-]+', '_', client_name).strip('._') or '_')
+
+
+def index_client(job):
+    '''
+    Runs in the worker processes, for every client before any of them is built
+
+    :param job: (client name, start date, export directory, output directory, force)
+    :return: (client name, OK|FAILED, seconds, error type, error message)
+    '''
+    client_name, start_date, exports, out_dir, force = job
+    started = default_timer()
+    try:
+        if not start_date:
+            raise ValueError('No start date for {}'.format(client_name))
+        files = export_paths(exports)
+        validate_exports(dict(zip(EXPORTS, files)))
+        index_projects(client_name, files[list(EXPORTS).index('projects')])
+    except (ExportError, IOError, OSError, ValueError) as error:
+        return client_name, FAILED, default_timer() - started, type(error).__name__, str(error)
+    except Exception as error:
+        return (client_name, FAILED, default_timer() - started, type(error).__name__,
+                traceback.format_exc())
+    return client_name, OK, default_timer() - started, None, None
+
+
+def index_projects(client_name, projects):
+    # The app is imported here so that each worker process sets it up once
+    from app import get_cost_index
+    from bpw_graphs import load_export, project_index_totals
+
+    cost_index = get_cost_index()
+    digest = update_digest(hashlib.sha1(), projects).hexdigest()
+    if cost_index.source_digest(client_name) == digest:
+        return
+    cost_index.update(client_name, project_index_totals(load_export('projects', projects)), digest)
+
+
+def build_client(job):
+    '''
+    Runs in the worker processes, once every client is in the cost index
+
+    :param job: (client name, start date, export directory, output directory, force)
+    :return: (client name, OK|SKIPPED|FAILED, seconds, error type, error message)
+    '''
+    from app import get_cost_index
+    from bpw_graphs import cost_comparison
+
+    client_name, start_date, exports, out_dir, force = job
+    started = default_timer()
+    try:
+        files = export_paths(exports)
+        key = DashboardCache.key(files, start_date)
+        comparison = cost_comparison(get_cost_index(), client_name)
+        target = client_dir(out_dir, client_name)
+        if not force and is_up_to_date(target, key, comparison):
+            return client_name, SKIPPED, default_timer() - started, None, None
+        write_dashboard(target, client_name, start_date, files, comparison)
+        with open(os.path.join(target, STAMP), 'w') as stamp:
+            json.dump(dict(key=key, client_name=client_name, start_date=start_date, comparison=comparison), stamp)
+    except (ExportError, IOError, OSError, ValueError) as error:
+        return client_name, FAILED, default_timer() - started, type(error).__name__, str(error)
+    except Exception as error:
+        # Anything else is a bug rather than a bad export, keep the traceback
+        return (client_name, FAILED, default_timer() - started, type(error).__name__,
+                traceback.format_exc())
+    return client_name, OK, default_timer() - started, None, None
+
+
+def is_up_to_date(target, key, comparison):
+    try:
+        with open(os.path.join(target, STAMP)) as stamp:
+            stamped = json.load(stamp)
+    except (IOError, ValueError):
+        return False
+    # The comparison changes with the other clients even when the exports of this one don't
+    if stamped.get('key') != key or stamped.get('comparison') != comparison:
+        return False
+    return all(os.path.exists(os.path.join(target, name)) for name in OUTPUTS)
+
+
+def write_dashboard(target, client_name, start_date, files, comparison):
+    from app import app
+    import bpw_charts
+    import bpw_pdf
+    from bpw_graphs import dashboard
+    from flask import render_template
+
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    chart_dir = app.config['CHART_DIR']
+    bpw_charts.configure('local', chart_dir)
+    # The client is in the cost index already, see index_client
+    dash_list = dashboard(*(files + [start_date]), client_name=client_name)
+    dash_list.append(comparison)
+
+    # The charts are written next to the HTML, so the output works without the app
+    for ref in [dash_list[0], dash_list[10], dash_list[12]]:
+        with io.open(os.path.join(target, ref + '.svg'), 'w', encoding='utf-8') as svg:
+            svg.write(bpw_charts.figure_svg(bpw_charts.load_figure(ref)))
+    with app.test_request_context():
+        html = render_template('dashboard_pdf.html', dash_list=dash_list, start_date=start_date,
+                               client_name=client_name, chart_image_url=lambda ref: ref + '.svg')
+    with io.open(os.path.join(target, 'dashboard.html'), 'w', encoding='utf-8') as html_file:
+        html_file.write(html)
+
+    base_url = 'file://' + os.path.abspath(target) + '/'
+    pdf = bpw_pdf.render(html, base_url, chart_dir, app.static_folder)
+    with open(os.path.join(target, 'dashboard.pdf'), 'wb') as pdf_file:
+        pdf_file.write(pdf)
+
+
+def write_combined(path, out_dir, client_names):
+    '''
+    :param path: the PDF to write
+    :param out_dir: the output directory of the batch
+    :param client_names: the clients to put in it, in order
+    '''
+    from app import app
+    import bpw_pdf
+
+    documents = []
+    for client_name in client_names:
+        target = client_dir(out_dir, client_name)
+        with io.open(os.path.join(target, 'dashboard.html'), encoding='utf-8') as html_file:
+            documents.append((html_file.read(), 'file://' + os.path.abspath(target) + '/'))
+    pdf = bpw_pdf.render_many(documents, app.config['CHART_DIR'], app.static_folder)
+    with open(path, 'wb') as pdf_file:
+        pdf_file.write(pdf)
+
+
+def report(done, total, result):
+    client_name, state, seconds, error_type, message = result
+    sys.stderr.write('[{}/{}] {:<8} {} ({:.1f} s){}\n'.format(
+        done, total, state, client_name, seconds,
+        '' if error_type is None else ': {}: {}'.format(error_type, (message.splitlines() or [''])[-1])))
+
+
+def write_errors(path, failures):
+    with open(path, 'w') as errors:
+        writer = csv.writer(errors)
+        writer.writerow(['client', 'error_type', 'error'])
+        for client_name, _, _, error_type, message in failures:
+            writer.writerow([client_name, error_type, message])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the dashboards of many clients')
+    parser.add_argument('clients', help='directory of client directories, or a manifest CSV file')
+    parser.add_argument('out_dir', help='where the dashboards are written')
+    parser.add_argument('--start', help='start date (mm/dd/YYYY) of clients without one in the manifest')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--force', action='store_true', help='rebuild clients that are up to date')
+    parser.add_argument('--combined', help='also write the dashboards of all the clients to this PDF')
+    parser.add_argument('--cost-index', help='the SQLite database of the cost index, instead of the one of the app')
+    args = parser.parse_args()
+
+    # The app is only used to render the templates, nothing is served
+    os.environ.setdefault('APP_SETTINGS', 'config.ProductionConfig')
+    os.environ.setdefault('BPW_DASH_SECRET_KEY', 'batch')
+    os.environ.setdefault('BPW_CHART_DIR', os.path.join(os.path.abspath(args.out_dir), '.charts'))
+    if args.cost_index:
+        os.environ['BPW_COST_INDEX_DB'] = os.path.abspath(args.cost_index)
+    # The clients already run on a pool of processes, whose workers can't start processes of their own
+    os.environ.setdefault('BPW_CHART_PROCESSES', '0')
+
+    clients = read_clients(args.clients, args.start)
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    jobs = [(name, start_date, exports, args.out_dir, args.force) for name, start_date, exports in clients]
+
+    counts = dict((state, 0) for state in (OK, SKIPPED, FAILED))
+    failures = []
+    built = set()
+    pool = multiprocessing.Pool(max(1, args.workers))
+    try:
+        # Every client goes in the cost index first, so no comparison depends on the order they finish in
+        indexed = set()
+        for result in pool.imap_unordered(index_client, jobs):
+            if result[1] == FAILED:
+                counts[FAILED] += 1
+                failures.append(result)
+                report('-', len(jobs), result)
+            else:
+                indexed.add(result[0])
+        jobs = [job for job in jobs if job[0] in indexed]
+
+        for done, result in enumerate(pool.imap_unordered(build_client, jobs), 1):
+            client_name, state, seconds, error_type, message = result
+            counts[state] += 1
+            if state == FAILED:
+                failures.append(result)
+            else:
+                built.add(client_name)
+            report(done, len(jobs), result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    errors_path = os.path.join(args.out_dir, 'errors.csv')
+    if failures:
+        write_errors(errors_path, sorted(failures))
+    elif os.path.exists(errors_path):
+        os.remove(errors_path)
+    if args.combined and built:
+        write_combined(args.combined, args.out_dir, [name for name, _, _ in clients if name in built])
+    print('{} built, {} up to date, {} failed{}'.format(
+        counts[OK], counts[SKIPPED], counts[FAILED], ', see ' + errors_path if failures else ''))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
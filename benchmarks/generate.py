@@ -0,0 +1,127 @@
+"""
+Writes synthetic Dataforma exports for benchmarking the bpw_graphs pipeline.
+
+    python -m benchmarks.generate OUT_DIR --rows 100000
+
+The four files have the column names and status strings bpw_graphs expects,
+plus some filler columns like the real exports. --rows is the number of work
+orders and receivables; there are half as many roofs and a fifth as many
+projects.
+"""
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+FILES = {
+    'roofs': 'Roof_Condition_Export.csv',
+    'worders': 'Work_Order_Export.csv',
+    'projects': 'Custom_Project_Export.csv',
+    'receivables': 'Custom_Accounts_Receivable_Export.csv',
+}
+
+CONDITIONS = ["Excellent", "Good", "Fair", "Poor", "Bad", None]
+SUBTYPES = ["Leak Call ", "Leak Call - Emergency", "Warranty - Leak Call", "Repairs ",
+            "Preventative Maintenance", None]
+WORKORDER_STATUSES = ["COMPLETED", "OPEN", "SCHEDULED", "CANCELLED"]
+RESPONSIBILITIES = ["INTERNAL CHARGE", "CLIENT", "CONTRACTOR"]
+WORKORDER_TYPES = ["Inspection", "Service", "Repair"]
+PROJECT_STATUSES = ["(1)PREPARING SPECFICIATION", "(2) BIDDING", "(3) PROPOSAL PENDING", "(4) APPROVED",
+                    "(5) PROPOSAL REJECTED", "(6) IN-PROGRESS", "(7) COMPLETED PENDING W.D.I.",
+                    "(8) COMPLETED", "(9) ON-HOLD"]
+PROJECT_TYPES = ["Reroof (Overlay)", "Reroof (Tear-off)", "Restoration", "Repair"]
+
+# Chunks keep the memory of the generator flat for the large sizes
+CHUNK_ROWS = 100000
+
+# The real exports have many more columns than the dashboard uses
+FILLER_COLUMNS = 8
+
+
+def money(values, dollar_sign=False):
+    template = '${:,.2f}' if dollar_sign else '{:,.2f}'
+    return pd.Series(values).map(template.format)
+
+
+def dates(random, size):
+    days = random.randint(0, 6 * 365, size)
+    return pd.Series(pd.Timestamp('2012-01-01') + pd.to_timedelta(days, unit='D')).dt.strftime('%m/%d/%Y')
+
+
+def notes(random, size):
+    sqft = pd.Series(random.randint(500, 90000, size)).map('Approx {:,} sq ft of roof area'.format)
+    # Some notes repeat, some have no numbers and some are missing
+    sqft[random.rand(size) < 0.2] = 'Standard terms apply'
+    sqft[random.rand(size) < 0.1] = None
+    return sqft
+
+
+def filler(frame, random, size):
+    for number in range(FILLER_COLUMNS):
+        frame['EXTRA {}'.format(number)] = random.randint(0, 1000, size)
+    return frame
+
+
+def chunk(name, random, start, size):
+    ids = np.arange(start, start + size)
+    if name == 'roofs':
+        frame = pd.DataFrame({'ROOF ID': ids,
+                              'Roof Condition': random.choice(CONDITIONS, size)})
+    elif name == 'worders':
+        frame = pd.DataFrame({'WORKORDER #': ids,
+                              'SUBTYPE': random.choice(SUBTYPES, size),
+                              'STATUS': random.choice(WORKORDER_STATUSES, size),
+                              'FINANCIAL_RESPONSIBILITY': random.choice(RESPONSIBILITIES, size),
+                              'STATUSDATE': dates(random, size)})
+    elif name == 'projects':
+        frame = pd.DataFrame({'PROJECT #': ids,
+                              'STATUS': random.choice(PROJECT_STATUSES, size),
+                              'STATUSDATE': dates(random, size),
+                              'BID AMOUNT': money(random.uniform(0, 500000, size), dollar_sign=True),
+                              'REVISEDCONTRACTAMOUNT': random.uniform(1000, 450000, size).round(2),
+                              'CONTRACT TERMS NOTES': notes(random, size),
+                              'TYPE': random.choice(PROJECT_TYPES, size)})
+    else:
+        frame = pd.DataFrame({'INVOICE #': ids,
+                              'INVOICE AMOUNT': money(random.uniform(50, 15000, size)),
+                              'WORKORDER SUBTYPE': random.choice(SUBTYPES, size),
+                              'WORKORDER TYPE': random.choice(WORKORDER_TYPES, size)})
+    return filler(frame, random, size)
+
+
+def sizes(rows):
+    return {'roofs': max(rows // 2, 1), 'worders': rows, 'projects': max(rows // 5, 1), 'receivables': rows}
+
+
+def generate(out_dir, rows=10000, seed=0):
+    '''
+    :param out_dir: directory the exports are written to
+    :param rows: number of work orders and receivables
+    :param seed: seed of the random generator
+    :return: a dictionary with the path of each export
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    random = np.random.RandomState(seed)
+    paths = {}
+    for name, total in sorted(sizes(rows).items()):
+        paths[name] = os.path.join(out_dir, FILES[name])
+        for start in range(0, total, CHUNK_ROWS):
+            frame = chunk(name, random, start, min(CHUNK_ROWS, total - start))
+            frame.to_csv(paths[name], index=False, header=start == 0, mode='w' if start == 0 else 'a')
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic Dataforma exports')
+    parser.add_argument('out_dir')
+    parser.add_argument('--rows', type=int, default=10000, help='number of work orders and receivables')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for name, path in sorted(generate(args.out_dir, args.rows, args.seed).items()):
+        print('{:<12} {}'.format(name, path))
+
+
+if __name__ == '__main__':
+    main()
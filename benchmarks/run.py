@@ -0,0 +1,251 @@
+"""
+Times each stage of the bpw_graphs pipeline on synthetic exports.
+
+    python -m benchmarks.run --rows 100000 --output results.json
+    python -m benchmarks.run --rows 100000 --baseline baseline.json
+
+Every stage is run --repeat times and the fastest run is kept; one more run
+measures the peak memory it allocated. Caches are cleared before every run. Charts are rendered with the local backend into a
+temporary directory, so nothing is uploaded. With --baseline the results are
+compared against an earlier --output and the exit status is 1 if any stage got
+slower than --tolerance allows.  The startup of a worker is checked against
+--startup-budget as well, see benchmarks.startup.  The stages whose peak memory
+is over --memory-budget times the size of the input files, plus
+MEMORY_ALLOWANCE for what the charts take at any size, are reported; the
+budget itself is checked by tests/test_memory.py.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+from functools import partial
+from collections import Counter
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pandas as pd
+
+import bpw_charts
+import bpw_graphs
+import bpw_tasks
+from bpw_schema import read_export
+from bpw_aggregate import merged
+from benchmarks import startup
+from benchmarks.generate import FILES, generate
+
+START_DATE = '01/01/2016'
+CHUNK_ROWS = 100000
+DASHBOARD_THREADS = 4
+
+# Peak memory of a stage, as a multiple of the size of the input files
+DEFAULT_MEMORY_BUDGET = 1.5
+# What plotly allocates for the figures however small the exports are
+MEMORY_ALLOWANCE = 8 * 1000 * 1000
+
+
+def measure(func, repeat, setup=None):
+    '''
+    :param func: the stage to run
+    :param repeat: how many times to time it
+    :param setup: run untimed before each run, to reset caches
+    :return: the result of the last run, the fastest time and the peak memory in bytes
+    '''
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = default_timer()
+        func()
+        elapsed = default_timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Tracing slows everything down, so the memory gets a run of its own
+    if setup is not None:
+        setup()
+    if tracemalloc is None:
+        return func(), best, None
+    tracemalloc.start()
+    try:
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def max_rss():
+    # Peak resident memory of the whole process, where the platform reports it
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run(paths, repeat=3):
+    '''
+    :param paths: a dictionary with the path of each export, see benchmarks.generate
+    :param repeat: how many times to run each stage
+    :return: a dictionary of results
+    '''
+    stages = []
+
+    def stage(name, func, setup=None):
+        result, seconds, peak = measure(func, repeat, setup)
+        stages.append(dict(name=name, seconds=seconds, peak_bytes=peak))
+        return result
+
+    frames = {}
+    for name in ['roofs', 'worders', 'projects', 'receivables']:
+        frames[name] = stage('read_csv:' + name, lambda: read_export(name, paths[name]))
+    roofs, worders = frames['roofs'], frames['worders']
+    projects, receivables = frames['projects'], frames['receivables']
+    projects["YEAR"] = projects["STATUSDATE"].dt.year
+
+    stage('count_conditions', lambda: bpw_graphs.count_conditions(roofs))
+    stage('upper_right_stats', lambda: bpw_graphs.upper_right_stats(worders, receivables, projects, START_DATE))
+    stage('second_graph_numbers', lambda: bpw_graphs.second_graph_numbers(projects, START_DATE))
+    stage('project_overlay_tearoff', lambda: bpw_graphs.project_overlay_tearoff(projects, START_DATE),
+          setup=bpw_graphs._sqft_memo.clear)
+    stage('avg_cost_inspection', lambda: bpw_graphs.avg_cost_inspection(receivables))
+
+    # The same totals straight from the files, CHUNK_ROWS rows at a time; the
+    # peak memory of this stage shouldn't grow with --rows
+    def chunked_totals():
+        totals = Counter()
+        for name in ['roofs', 'worders', 'projects', 'receivables']:
+            chunks = read_export(name, paths[name], chunksize=CHUNK_ROWS)
+            totals.update(merged(partial(bpw_graphs.export_totals, name), chunks, START_DATE))
+        return totals
+    stage('chunked_totals', chunked_totals, setup=bpw_graphs._sqft_memo.clear)
+
+    chart_dir = tempfile.mkdtemp(prefix='bpw-bench-charts-')
+    try:
+        bpw_charts.configure('local', chart_dir)
+        stage('charts', lambda: (bpw_graphs.pie_chart_url(roofs), bpw_graphs.second_graph_url(projects, START_DATE),
+                                 bpw_graphs.trend_chart_url(projects)),
+              setup=bpw_graphs._sqft_memo.clear)
+
+        # The whole dashboard with its stages one after another, then as a graph (see bpw_tasks)
+        files = [paths[name] for name in ['roofs', 'worders', 'projects', 'receivables']]
+        bpw_tasks.configure(threads=1)
+        stage('dashboard:serial', lambda: bpw_graphs.dashboard(*(files + [START_DATE])),
+              setup=bpw_graphs._sqft_memo.clear)
+        bpw_tasks.configure(threads=DASHBOARD_THREADS)
+        stage('dashboard', lambda: bpw_graphs.dashboard(*(files + [START_DATE])),
+              setup=bpw_graphs._sqft_memo.clear)
+    finally:
+        shutil.rmtree(chart_dir, ignore_errors=True)
+
+    return dict(
+        rows=dict((name, len(frame)) for name, frame in frames.items()),
+        input_bytes=sum(os.path.getsize(path) for path in paths.values()),
+        python=platform.python_version(),
+        pandas=pd.__version__,
+        repeat=repeat,
+        stages=stages,
+        total_seconds=sum(item['seconds'] for item in stages),
+        max_rss_bytes=max_rss(),
+    )
+
+
+def compare(results, baseline, tolerance):
+    '''
+    :param results: results from run
+    :param baseline: earlier results from run
+    :param tolerance: allowed slowdown, 0.2 is 20% slower
+    :return: a list of (stage, baseline seconds, seconds, ratio, regressed)
+    '''
+    before = dict((item['name'], item['seconds']) for item in baseline['stages'])
+    rows = []
+    for item in results['stages'] + [dict(name='total', seconds=results['total_seconds'])]:
+        old = baseline['total_seconds'] if item['name'] == 'total' else before.get(item['name'])
+        if not old:
+            continue
+        ratio = item['seconds'] / old
+        rows.append((item['name'], old, item['seconds'], ratio, ratio > 1 + tolerance))
+    return rows
+
+
+def check_memory(results, budget):
+    '''
+    :param results: results from run
+    :param budget: the most memory a stage may allocate at its peak, as a multiple of the input size
+    :return: a list of the problems, empty if every stage is within the budget
+    '''
+    limit = budget * results['input_bytes'] + MEMORY_ALLOWANCE
+    return ['{} peaked at {:,.1f} MB, over the budget of {:,.1f} MB'.format(
+        item['name'], item['peak_bytes'] / 1e6, limit / 1e6)
+        for item in results['stages'] if item['peak_bytes'] is not None and item['peak_bytes'] > limit]
+
+
+def print_results(results, comparison=None):
+    print('rows: {}  input: {:,.1f} MB  python {}  pandas {}'.format(
+        ', '.join('{}={:,}'.format(name, count) for name, count in sorted(results['rows'].items())),
+        results['input_bytes'] / 1e6, results['python'], results['pandas']))
+    for item in results['stages']:
+        peak = '' if item['peak_bytes'] is None else '{:>10,.1f} MB'.format(item['peak_bytes'] / 1e6)
+        print('{:<26} {:>9.4f} s {}'.format(item['name'], item['seconds'], peak))
+    print('{:<26} {:>9.4f} s'.format('total', results['total_seconds']))
+    for name, old, new, ratio, regressed in comparison or []:
+        print('{:<26} {:>9.4f} s -> {:>9.4f} s  x{:.2f}{}'.format(
+            name, old, new, ratio, '  REGRESSION' if regressed else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bpw_graphs pipeline')
+    parser.add_argument('--rows', type=int, default=10000, help='size of the synthetic exports')
+    parser.add_argument('--data', help='directory with exports from benchmarks.generate, instead of --rows')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --output')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--startup-budget', type=float, default=startup.DEFAULT_BUDGET,
+                        help='seconds a new worker may take to serve the upload form')
+    parser.add_argument('--memory-budget', type=float, default=DEFAULT_MEMORY_BUDGET,
+                        help='report stages that allocate more than this at their peak, as a multiple of the '
+                             'size of the input files')
+    args = parser.parse_args()
+
+    data_dir = args.data or tempfile.mkdtemp(prefix='bpw-bench-data-')
+    try:
+        if args.data:
+            paths = dict((name, os.path.join(data_dir, filename)) for name, filename in FILES.items())
+        else:
+            paths = generate(data_dir, args.rows, args.seed)
+        results = run(paths, args.repeat)
+    finally:
+        if not args.data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            comparison = compare(results, json.load(baseline_file), args.tolerance)
+    results['startup'] = startup.measure(args.repeat)
+    startup_problems = startup.check(results['startup'], args.startup_budget)
+    memory_problems = check_memory(results, args.memory_budget)
+    print_results(results, comparison)
+    startup.print_startup(results['startup'], startup_problems)
+    for problem in memory_problems:
+        print('OVER MEMORY BUDGET: ' + problem)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if comparison and any(row[-1] for row in comparison) or startup_problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
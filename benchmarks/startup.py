@@ -0,0 +1,107 @@
+"""
+Checks how fast a new gunicorn worker can serve the upload form.
+
+    python -m benchmarks.startup --budget 1.5
+
+Each run starts a fresh interpreter that imports the app and requests the
+index page, like a worker does after it is forked without preloading. The
+fastest of --repeat runs is kept. The exit status is 1 if that takes longer
+than --budget seconds, or if pandas, numpy, plotly or WeasyPrint were imported
+on the way, since those belong to the first dashboard, not to the start.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that only the dashboards and the PDFs need
+HEAVY = ['pandas', 'numpy', 'plotly', 'weasyprint']
+
+DEFAULT_BUDGET = 1.5
+
+CHILD = '''
+import sys
+import json
+from timeit import default_timer
+
+started = default_timer()
+from app import app
+imported = default_timer()
+status = app.test_client().get('/').status_code
+served = default_timer()
+print(json.dumps(dict(import_seconds=imported - started, request_seconds=served - imported, status=status,
+                      heavy=[name for name in {heavy!r} if name in sys.modules])))
+'''.format(heavy=HEAVY)
+
+
+def measure(repeat=5):
+    '''
+    :param repeat: how many fresh interpreters to time
+    :return: a dictionary with the fastest seconds to import the app and serve the index page,
+        split in import_seconds and request_seconds, and the heavy modules that got imported
+    '''
+    state_dir = tempfile.mkdtemp(prefix='bpw-bench-startup-')
+    env = dict(os.environ)
+    env.setdefault('APP_SETTINGS', 'config.ProductionConfig')
+    env.setdefault('BPW_DASH_SECRET_KEY', 'benchmark')
+    # Whatever the app creates on startup goes to a scratch directory
+    for name in ['CHART_DIR', 'CACHE_DIR', 'JOB_DIR', 'COLUMN_DIR', 'UPLOAD_DIR', 'PDF_DIR']:
+        env['BPW_' + name] = os.path.join(state_dir, name.lower())
+    for name in ['RESULT_DB', 'INCREMENTAL_DB']:
+        env['BPW_' + name] = os.path.join(state_dir, name.lower() + '.db')
+
+    best = None
+    try:
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', CHILD], cwd=ROOT, env=env)
+            run = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            run['seconds'] = run['import_seconds'] + run['request_seconds']
+            if best is None or run['seconds'] < best['seconds']:
+                best = run
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+    return best
+
+
+def check(startup, budget):
+    '''
+    :param startup: the result of measure
+    :param budget: the most seconds a worker may take to serve the index page
+    :return: a list of the problems, empty if the startup is within the budget
+    '''
+    problems = []
+    if startup['status'] != 200:
+        problems.append('the index page answered {}'.format(startup['status']))
+    if startup['seconds'] > budget:
+        problems.append('{:.3f} s is over the budget of {:.3f} s'.format(startup['seconds'], budget))
+    if startup['heavy']:
+        problems.append('imported {} on startup'.format(', '.join(startup['heavy'])))
+    return problems
+
+
+def print_startup(startup, problems):
+    print('{:<26} {:>9.4f} s (import {:.4f} s, index page {:.4f} s){}'.format(
+        'startup', startup['seconds'], startup['import_seconds'], startup['request_seconds'],
+        ''.join('  OVER BUDGET: ' + problem for problem in problems)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check how fast a worker serves the upload form')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help='seconds a worker may take')
+    args = parser.parse_args()
+
+    startup = measure(args.repeat)
+    problems = check(startup, args.budget)
+    print_startup(startup, problems)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+from collections import Counter
+
+import pandas as pd
+
+# The aggregation layer behind the dashboard numbers.  Every table is reduced
+# with one groupby/value_counts pass into a Counter of totals.  Totals only
+# hold counts and sums, never averages, so partial totals from several frames
+# can be merged with Counter.update and the averages are taken at the end with
+# mean().  That is also what lets a large export be aggregated one chunk at a
+# time with merged().
+#
+# The keys of the totals are tuples that start with the name of the metric:
+#
+#   roofs:        ('condition', label)
+#   worders:      ('completed_subtype', subtype), ('internal_charge', subtype)
+#   receivables:  ('subtype_invoices', subtype), ('subtype_amounts', subtype),
+#                 ('subtype_total', subtype) and the same for the work order
+#                 type as 'worktype_invoices', 'worktype_amounts', 'worktype_total'
+#   projects:     ('status', status), ('status_since', status),
+#                 ('completed', 'count'|'bid'|'spread'|'spreads')
+#   project cost: ('type_revised', type), ('type_sqft', type),
+#                 ('band_revised', type, band), ('band_sqft', type, band)
+#   trend:        ('trend_status', period, status),
+#                 ('trend_completed', period, 'count'|'bid'|'spread'|'spreads')
+#   cost index:   ('index_revised', type, band, year), ('index_sqft', type, band, year)
+#                 where band may be ALL_BANDS and year ALL_YEARS (see bpw_index)
+#
+# The trend totals split 'status_since' and 'completed' by the period the
+# projects fall in.  Adding up the periods from the last one back to a period
+# gives the totals for a start date at the beginning of that period, so one
+# pass serves a report for every period.
+
+LEAK_CALLS = ["Leak Call ", "Leak Call - Emergency"]
+COMPLETED = ["(8) COMPLETED", "(7) COMPLETED PENDING W.D.I."]
+
+SQFT_LABELS = ["0-10,000", "10,000-25,000", "25,000-50,000", "50,000 and up"]
+SQFT_BINS = [0, 10000, 25000, 50000, 9000000]
+
+# The band and year of the cost index totals over all bands or all years
+ALL_BANDS = 'All sizes'
+ALL_YEARS = 0
+
+
+def categorical(values):
+    '''
+    :param values: a pandas series
+    :return: the series as a categorical, converted only if it isn't one already
+    '''
+    if str(values.dtype) == 'category':
+        return values
+    return values.astype('category')
+
+
+def add(totals, metric, counts):
+    '''
+    :param totals: a Counter of totals
+    :param metric: name of the metric
+    :param counts: a pandas series of counts or sums indexed by label
+    :return: the totals, updated in place
+    '''
+    for label, value in counts.items():
+        if pd.isnull(value) or not value:
+            continue
+        label = label if isinstance(label, tuple) else (label,)
+        totals[(metric,) + label] += value.item() if hasattr(value, 'item') else value
+    return totals
+
+
+def mean(total, count):
+    '''
+    :return: total / count, NaN when there is nothing to average like pandas' mean
+    '''
+    if not count:
+        return float('nan')
+    return total / float(count)
+
+
+def merged(totals_func, frames, *args):
+    '''
+    :param totals_func: one of the *_totals functions
+    :param frames: a pandas dataframe, or an iterable of chunks of one
+    :param args: the other arguments of totals_func
+    :return: the totals of the dataframe or of all the chunks
+    '''
+    if isinstance(frames, pd.DataFrame):
+        return totals_func(frames, *args)
+    totals = Counter()
+    for frame in frames:
+        totals.update(totals_func(frame, *args))
+    return totals
+
+
+def roof_totals(roofs):
+    '''
+    :param roofs: a pandas dataframe of roof conditions
+    :return: a Counter with the number of roofs in each condition
+    '''
+    return add(Counter(), 'condition', categorical(roofs['Roof Condition']).value_counts())
+
+
+def worder_totals(worders):
+    '''
+    :param worders: a pandas dataframe of work orders
+    :return: a Counter with the completed work orders and those charged internally, per subtype
+    '''
+    totals = Counter()
+    completed = worders[(worders["STATUS"] == "COMPLETED") & pd.notnull(worders["SUBTYPE"])]
+    internal = (completed['FINANCIAL_RESPONSIBILITY'] == 'INTERNAL CHARGE').rename('INTERNAL')
+    counts = completed.groupby([categorical(completed['SUBTYPE']), internal]).size()
+    for (subtype, is_internal), count in counts.items():
+        if not count:
+            continue
+        totals[('completed_subtype', subtype)] += int(count)
+        if is_internal:
+            totals[('internal_charge', subtype)] += int(count)
+    return totals
+
+
+def receivable_totals(receivables):
+    '''
+    :param receivables: a pandas dataframe of receivables
+    :return: a Counter with the number of invoices, of invoice amounts and their sum
+        per work order subtype and per work order type
+    '''
+    totals = Counter()
+    amounts = receivables['INVOICE AMOUNT']
+    for prefix, column in [('subtype', 'WORKORDER SUBTYPE'), ('worktype', 'WORKORDER TYPE')]:
+        grouped = amounts.groupby(categorical(receivables[column]))
+        add(totals, prefix + '_invoices', grouped.size())
+        add(totals, prefix + '_amounts', grouped.count())
+        add(totals, prefix + '_total', grouped.sum())
+    return totals
+
+
+def project_totals(projects, start_date):
+    '''
+    :param projects: a pandas dataframe of projects
+    :param start_date: start date of the report
+    :return: a Counter with the projects per status, all time and since start_date,
+        and the count, bid and spread sums of the projects completed after start_date
+    '''
+    totals = Counter()
+    start = pd.Timestamp(start_date)
+    since = (projects['STATUSDATE'] >= start).rename('SINCE')
+
+    counts = projects.groupby([categorical(projects['STATUS']), since]).size()
+    for (status, is_since), count in counts.items():
+        if not count:
+            continue
+        totals[('status', status)] += int(count)
+        if is_since:
+            totals[('status_since', status)] += int(count)
+
+    mask = (projects['STATUS'].isin(COMPLETED) & (projects['STATUSDATE'] > start) &
+            (projects['BID AMOUNT'] > 1))
+    bids = projects['BID AMOUNT'][mask]
+    spreads = bids - projects['REVISEDCONTRACTAMOUNT'][mask]
+    totals[('completed', 'count')] += int(mask.sum())
+    totals[('completed', 'bid')] += float(bids.sum())
+    totals[('completed', 'spread')] += float(spreads.sum())
+    totals[('completed', 'spreads')] += int(spreads.count())
+    return totals
+
+
+def periods(dates, freq='A'):
+    '''
+    :param dates: a pandas series of datetimes
+    :param freq: 'A' for years, 'M' for months
+    :return: the period of each date, the year as an int or the month as 'YYYY-MM'
+    '''
+    if freq == 'A':
+        return dates.dt.year
+    return dates.dt.strftime('%Y-%m').where(pd.notnull(dates))
+
+
+def trend_totals(projects, freq='A'):
+    '''
+    :param projects: a pandas dataframe of projects
+    :param freq: 'A' for years, 'M' for months
+    :return: a Counter with the status_since and completed totals of project_totals for
+        the projects of each period
+    '''
+    totals = Counter()
+    dates = projects['STATUSDATE']
+    # The year column made by bpw_graphs.dashboard is the same bucket
+    since = projects['YEAR'] if freq == 'A' and 'YEAR' in projects else periods(dates, freq)
+    counts = projects.groupby([since.rename('PERIOD'), categorical(projects['STATUS'])]).size()
+    for (period, status), count in counts.items():
+        if count:
+            totals[('trend_status', _period(period), status)] += int(count)
+
+    # A completed project counts for start dates strictly before it, so one
+    # at the very start of a period belongs to the period before
+    mask = (projects['STATUS'].isin(COMPLETED) & pd.notnull(dates) & (projects['BID AMOUNT'] > 1))
+    completed = periods(dates[mask] - pd.Timedelta(1, 'ns'), freq)
+    bids = projects['BID AMOUNT'][mask]
+    spreads = bids - projects['REVISEDCONTRACTAMOUNT'][mask]
+    frame = pd.DataFrame({'bid': bids, 'spread': spreads})
+    grouped = frame.groupby(completed.rename('PERIOD'))
+    for metric, values in [('count', grouped.size()), ('bid', grouped['bid'].sum()),
+                           ('spread', grouped['spread'].sum()), ('spreads', grouped['spread'].count())]:
+        for period, value in values.items():
+            if value:
+                value = value.item() if hasattr(value, 'item') else value
+                totals[('trend_completed', _period(period), metric)] += value
+    return totals
+
+
+def _period(period):
+    # Years come out of pandas as floats when there are missing dates
+    return int(period) if isinstance(period, float) or hasattr(period, 'item') else period
+
+
+def cost_totals(projects, sqft):
+    '''
+    :param projects: a pandas dataframe of projects
+    :param sqft: a pandas series with the square footage of those projects
+    :return: a Counter with the contract amount and square footage per project type
+        and per project type and size band
+    '''
+    totals = Counter()
+    bands = pd.cut(sqft, bins=SQFT_BINS, labels=SQFT_LABELS)
+    frame = pd.DataFrame({'REVISEDCONTRACTAMOUNT': projects['REVISEDCONTRACTAMOUNT'], 'SQFT': sqft})
+
+    by_band = frame.groupby([projects['TYPE'], bands]).sum()
+    add(totals, 'band_revised', by_band['REVISEDCONTRACTAMOUNT'])
+    add(totals, 'band_sqft', by_band['SQFT'])
+    # The type totals also count projects too large for any band
+    by_type = frame.groupby(projects['TYPE']).sum()
+    add(totals, 'type_revised', by_type['REVISEDCONTRACTAMOUNT'])
+    add(totals, 'type_sqft', by_type['SQFT'])
+    return totals
+
+
+def index_totals(projects, sqft):
+    '''
+    :param projects: a pandas dataframe of projects
+    :param sqft: a pandas series with the square footage of those projects
+    :return: a Counter with the contract amount and square footage per project type, size
+        band and year of the status date, and the same over all bands and over all years
+    '''
+    totals = Counter()
+    frame = pd.DataFrame({'REVISEDCONTRACTAMOUNT': projects['REVISEDCONTRACTAMOUNT'], 'SQFT': sqft})
+    bands = pd.cut(sqft, bins=SQFT_BINS, labels=SQFT_LABELS).astype(object)
+    years = projects['STATUSDATE'].dt.year
+
+    for band_key in [bands, pd.Series(ALL_BANDS, index=frame.index)]:
+        for year_key in [years, pd.Series(ALL_YEARS, index=frame.index)]:
+            # Rows without a band or a year only count towards the totals over all of them
+            grouped = frame.groupby([projects['TYPE'], band_key, year_key]).sum()
+            for metric, column in [('index_revised', 'REVISEDCONTRACTAMOUNT'), ('index_sqft', 'SQFT')]:
+                for (project_type, band, year), value in grouped[column].items():
+                    if pd.notnull(value) and value:
+                        totals[(metric, project_type, band, int(year))] += float(value)
+    return totals
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict, Counter
+
+from bpw_metrics import registry, enabled as metrics_enabled
+from bpw_index import INDEX_KEYS
+
+# A result cache for bpw_graphs.dashboard.  The key is a hash of the four
+# uploaded CSV files and the start date, so re-uploading the same exports
+# (even for a different client name) skips parsing and chart rendering.
+# What the exports put in the cost index (see bpw_index) is cached with the
+# dashboard, so a hit still puts the client in the index, or brings it back to
+# these exports after the client was run with others.
+#
+# There are two tiers:
+#   memory: a size bounded LRU with a TTL, private to each worker
+#   disk:   one JSON file per key in CACHE_DIR, shared by all workers and
+#           kept across gunicorn restarts; also an LRU with a TTL, the
+#           modification time of a file is when it was written and its
+#           access time, set on every hit, when it was last used
+
+# Bump this when the dashboard output changes so old entries are ignored
+KEY_VERSION = '4'
+
+# Files are hashed a block at a time, so they never have to be in memory
+BLOCK_SIZE = 1024 * 1024
+
+
+def update_digest(digest, path):
+    '''
+    :param digest: a hashlib object
+    :param path: a file whose size and contents are added to the digest
+    :return: the digest
+    '''
+    # The size keeps the boundaries between files unambiguous
+    digest.update('{}:'.format(os.path.getsize(path)).encode('utf-8'))
+    with open(path, 'rb') as hashed:
+        for block in iter(lambda: hashed.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest
+
+
+class DashboardCache(object):
+
+    def __init__(self, cache_dir=None, max_entries=128, ttl=24 * 60 * 60, max_disk_entries=1024):
+        '''
+        :param cache_dir: directory of the disk tier, None keeps the cache in memory only
+        :param max_entries: number of results kept in memory
+        :param ttl: seconds before a result expires
+        :param max_disk_entries: number of results kept on disk
+        '''
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(files, start_date, *extra):
+        '''
+        :param files: the paths of the uploaded files
+        :param start_date: start date of the report
+        :param extra: anything else the result depends on
+        :return: a hex digest identifying the result
+        '''
+        digest = hashlib.sha1(KEY_VERSION.encode('utf-8'))
+        for path in files:
+            update_digest(digest, path)
+        for value in (start_date,) + extra:
+            digest.update(u'|{}'.format(value).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        '''
+        :param key: a key from DashboardCache.key
+        :return: the cached result or None
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored, value = entry
+                if now - stored < self.ttl:
+                    self._entries.pop(key)
+                    self._entries[key] = entry
+                    self._touch(key, now)
+                    return value
+                del self._entries[key]
+
+        entry = self._read(key, now)
+        if entry is not None:
+            with self._lock:
+                self._remember(key, entry)
+            self._touch(key, now)
+            return entry[1]
+        return None
+
+    def _touch(self, key, now):
+        # Marks the file as used for the LRU of the disk tier, keeping when it was written
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        try:
+            os.utime(path, (now, os.path.getmtime(path)))
+        except OSError:
+            pass
+
+    def set(self, key, value):
+        '''
+        :param key: a key from DashboardCache.key
+        :param value: a JSON serializable result
+        '''
+        entry = (time.time(), value)
+        with self._lock:
+            self._remember(key, entry)
+        self._write(key, value)
+
+    def _remember(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _read(self, key, now):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            stored = os.path.getmtime(path)
+            if now - stored >= self.ttl:
+                os.remove(path)
+                return None
+            with open(path) as cache_file:
+                return stored, json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, key, value):
+        if not self.cache_dir:
+            return
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as tmp:
+            json.dump(value, tmp)
+        os.rename(tmp_path, path)
+        self._prune()
+
+    def _prune(self):
+        # Drop expired files, then the least recently used ones over the limit
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime >= self.ttl:
+                    os.remove(path)
+                else:
+                    entries.append((max(stat.st_atime, stat.st_mtime), path))
+            except OSError:
+                continue
+        entries.sort()
+        for used, path in entries[:max(len(entries) - self.max_disk_entries, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class _RecordedIndex(object):
+    # Passed to dashboard in place of the cost index, to keep what it puts there
+
+    def __init__(self, cost_index):
+        self.cost_index = cost_index
+        self.totals = None
+
+    def update(self, client_name, totals):
+        self.totals = totals
+        self.cost_index.update(client_name, totals)
+
+
+def encode_index_totals(totals):
+    # Only the index totals, the dashboard totals can be many more
+    return sorted([list(key), value] for key, value in totals.items() if key[0] in INDEX_KEYS)
+
+
+def decode_index_totals(payload):
+    return Counter(dict((tuple(key), value) for key, value in payload))
+
+
+def cached_dashboard(cache, roofs, worders, projects, receivables, start_date, *extra, **options):
+    '''
+    :param cache: a DashboardCache
+    :param roofs, worders, projects, receivables: the paths of the uploaded files
+    :param start_date: start date of the report
+    :param extra: anything else the result depends on, like the chart backend
+    :param options: passed on to dashboard, they must not change the result; with a cost_index
+        the client_name is put in the index whether the dashboard was cached or not
+    :return: the dash_list from bpw_graphs.dashboard
+    '''
+    key = cache.key([roofs, worders, projects, receivables], start_date, *extra)
+    entry = cache.get(key)
+    cost_index = options.get('cost_index')
+    if entry is not None and cost_index is not None and entry.get('index_totals') is None:
+        # Cached without a cost index, so what the client puts there is unknown
+        entry = None
+    if metrics_enabled():
+        registry.inc('bpw_cache_requests_total', result='miss' if entry is None else 'hit')
+    if entry is None:
+        from bpw_graphs import dashboard
+        if cost_index is not None:
+            options['cost_index'] = _RecordedIndex(cost_index)
+        entry = dict(dash_list=dashboard(roofs, worders, projects, receivables, start_date, **options))
+        if cost_index is not None:
+            entry['index_totals'] = encode_index_totals(options['cost_index'].totals)
+        cache.set(key, entry)
+    elif cost_index is not None:
+        # The same exports uploaded for another client, or for this one after other exports
+        cost_index.update(options.get('client_name'), decode_index_totals(entry['index_totals']))
+    return entry['dash_list']
@@ -0,0 +1,556 @@
+import os
+import re
+import json
+import math
+import time
+import hashlib
+from collections import OrderedDict
+
+from bpw_metrics import timed
+
+# This module holds the chart backends used by bpw_graphs.  The figures are built
+# the same way as before; a backend decides what happens to them afterwards:
+#
+#   local:  the figure is written as JSON to CHART_DIR under a content hash and
+#           served by the Flask app (interactive embed page and a static SVG)
+#   plotly: the figure is uploaded to the Plotly cloud as before (optional mode)
+#
+# Either way render_chart() returns a chart reference that goes into dash_list.
+# Local references are the 40 character hash, cloud references are plot.ly URLs.
+#
+# Local charts are shared by every dashboard that draws the same figure, so a
+# chart file is kept as long as the newest dashboard that uses it: storing a
+# dashboard touches its charts (keep_charts) and prune_charts removes the ones
+# no dashboard touched for longer than the dashboards are kept.
+
+CHART_ID = re.compile(r'^[0-9a-f]{40}$')
+
+DEFAULT_CHART_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'charts')
+
+# Plotly's default trace colors, used by the SVG renderer
+COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+          '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+
+
+def figure_json(fig):
+    '''
+    :param fig: a plotly figure or a dictionary
+    :return: a canonical JSON string of the figure
+    '''
+    from plotly.utils import PlotlyJSONEncoder
+
+    fig = json.loads(json.dumps(fig, cls=PlotlyJSONEncoder))
+    # Newer plotly versions stamp every trace with a random uid
+    for trace in fig.get('data', []):
+        trace.pop('uid', None)
+    return json.dumps(fig, sort_keys=True, separators=(',', ':'))
+
+
+def chart_id(payload):
+    '''
+    :param payload: the canonical JSON of a figure
+    :return: the content hash used as the chart id
+    '''
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def is_local(ref):
+    '''
+    :param ref: a chart reference from dash_list
+    :return: True if the chart is served by this app
+    '''
+    return bool(ref) and CHART_ID.match(ref) is not None
+
+
+class LocalChartBackend(object):
+    '''
+    Keeps the figures on the local disk so nothing leaves the server.
+    '''
+
+    name = 'local'
+
+    def __init__(self, chart_dir=DEFAULT_CHART_DIR):
+        self.chart_dir = chart_dir
+
+    def path(self, ref):
+        if not is_local(ref):
+            raise KeyError(ref)
+        return os.path.join(self.chart_dir, ref + '.json')
+
+    def render(self, fig, name):
+        payload = figure_json(fig)
+        ref = chart_id(payload)
+        path = self.path(ref)
+        if not os.path.exists(path):
+            if not os.path.isdir(self.chart_dir):
+                try:
+                    os.makedirs(self.chart_dir)
+                except OSError:
+                    if not os.path.isdir(self.chart_dir):
+                        raise
+            # Write to a temporary file first so readers never see half a chart
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'w') as tmp:
+                tmp.write(payload)
+            os.rename(tmp_path, path)
+        else:
+            # Drawn again, so it is as new as a chart written now
+            self.touch([ref])
+        return ref
+
+    def load(self, ref):
+        try:
+            with open(self.path(ref)) as chart_file:
+                return json.load(chart_file)
+        except IOError:
+            raise KeyError(ref)
+
+    def touch(self, refs):
+        for ref in refs:
+            try:
+                os.utime(self.path(ref), None)
+            except (KeyError, OSError):
+                continue
+
+    def prune(self, ttl):
+        if not os.path.isdir(self.chart_dir):
+            return
+        now = time.time()
+        for name in os.listdir(self.chart_dir):
+            path = os.path.join(self.chart_dir, name)
+            try:
+                if now - os.path.getmtime(path) >= ttl:
+                    os.remove(path)
+            except OSError:
+                continue
+
+
+class PlotlyCloudBackend(object):
+    '''
+    Uploads the figures to the Plotly cloud, like the dashboard originally did.
+    '''
+
+    name = 'plotly'
+
+    def __init__(self, username=None, api_key=None):
+        # The credentials are only needed by the first upload, not to start the app
+        self.username = username
+        self.api_key = api_key
+        self._signed_in = False
+
+    def render(self, fig, name):
+        import plotly.plotly as py
+
+        if not self._signed_in:
+            py.sign_in(username=self.username or os.environ['PLOTLY_USER_NAME'],
+                       api_key=self.api_key or os.environ['PLOTLY_API_KEY'])
+            self._signed_in = True
+
+        # The content hash keeps concurrent users from overwriting each other's charts
+        filename = '{} {}'.format(name, chart_id(figure_json(fig))[:12])
+        return py.plot(fig, filename=filename, auto_open=False)
+
+    def load(self, ref):
+        raise KeyError(ref)
+
+
+BACKENDS = {
+    LocalChartBackend.name: LocalChartBackend,
+    PlotlyCloudBackend.name: PlotlyCloudBackend,
+}
+
+_backend = None
+
+
+def configure(backend='local', chart_dir=None):
+    '''
+    :param backend: the name of the chart backend, 'local' or 'plotly'
+    :param chart_dir: where the local backend keeps the figures
+    :return: the configured backend
+    '''
+    global _backend
+
+    if backend not in BACKENDS:
+        raise ValueError('Unknown chart backend: {}'.format(backend))
+    if backend == LocalChartBackend.name:
+        _backend = LocalChartBackend(chart_dir or DEFAULT_CHART_DIR)
+    else:
+        _backend = BACKENDS[backend]()
+    return _backend
+
+
+def get_backend():
+    if _backend is None:
+        configure(os.environ.get('BPW_CHART_BACKEND', 'local'), os.environ.get('BPW_CHART_DIR'))
+    return _backend
+
+
+def render_chart(fig, name):
+    '''
+    :param fig: a plotly figure or a dictionary
+    :param name: a human readable name of the chart
+    :return: a chart reference for dash_list
+    '''
+    backend = get_backend()
+    with timed('render_chart:' + backend.name):
+        return backend.render(fig, name)
+
+
+def load_figure(ref):
+    '''
+    :param ref: a local chart reference
+    :return: the figure as a dictionary, raises KeyError if it is unknown
+    '''
+    backend = get_backend()
+    if not isinstance(backend, LocalChartBackend):
+        backend = LocalChartBackend(os.environ.get('BPW_CHART_DIR') or DEFAULT_CHART_DIR)
+    return backend.load(ref)
+
+
+def keep_charts(refs):
+    '''
+    Marks the local charts as used now, so prune_charts keeps them for another ttl
+
+    :param refs: chart references from dash_list, the cloud ones are ignored
+    '''
+    backend = get_backend()
+    if isinstance(backend, LocalChartBackend):
+        backend.touch([ref for ref in refs if is_local(ref)])
+
+
+def prune_charts(ttl):
+    '''
+    :param ttl: seconds since a local chart was last rendered or kept, after which it is removed
+    '''
+    backend = get_backend()
+    if isinstance(backend, LocalChartBackend):
+        backend.prune(ttl)
+
+
+def figure_div(fig):
+    '''
+    :param fig: the figure as a dictionary
+    :return: an HTML div that draws the figure with plotly.js
+    '''
+    from plotly.offline import plot
+
+    return plot(fig, output_type='div', include_plotlyjs=False, show_link=False, validate=False)
+
+
+def plotly_js():
+    '''
+    :return: the plotly.js bundle that ships with the plotly package
+    '''
+    from plotly.offline.offline import get_plotlyjs
+
+    return get_plotlyjs()
+
+
+# A small SVG renderer for the dashboard figures.  WeasyPrint can't run
+# plotly.js, so the PDF uses these static images instead.  Only what the
+# dashboard uses is supported: pie traces, bar traces, grouped or not, with a
+# legend, and paper or data referenced annotations.
+
+def figure_svg(fig):
+    '''
+    :param fig: the figure as a dictionary
+    :return: an SVG document as a string
+    '''
+    layout = fig.get('layout', {})
+    width = layout.get('width') or 600
+    height = layout.get('height') or 500
+    margin = dict(l=80, r=80, t=100, b=80)
+    margin.update(layout.get('margin') or {})
+    font_size = (layout.get('font') or {}).get('size') or 12
+    area = (margin['l'], margin['t'], width - margin['l'] - margin['r'],
+            height - margin['t'] - margin['b'])
+
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" '
+             'viewBox="0 0 {0} {1}" font-family="Arial, sans-serif">'.format(width, height),
+             '<rect width="{}" height="{}" fill="{}"/>'.format(
+                 width, height, _svg_color(layout.get('paper_bgcolor'), '#ffffff'))]
+
+    title = _title_text(layout.get('title'))
+    if title:
+        title_font = layout.get('titlefont') or {}
+        if isinstance(layout.get('title'), dict):
+            title_font = layout['title'].get('font') or title_font
+        title_size = title_font.get('size') or font_size + 5
+        parts.append(_svg_text(title, width / 2.0, margin['t'] / 2.0, title_size, anchor='middle'))
+
+    # The bar traces of a subplot share its scale, and with barmode 'group'
+    # each one gets its own slot of every category
+    subplots = OrderedDict()
+    for index, trace in enumerate(fig.get('data', [])):
+        if trace.get('type') == 'pie':
+            parts.extend(_svg_pie(trace, area, font_size))
+        elif trace.get('type', 'bar') == 'bar':
+            key = (_axis_ref(trace.get('xaxis', 'x')), _axis_ref(trace.get('yaxis', 'y')))
+            subplots.setdefault(key, []).append((index, trace))
+
+    axes = {}
+    grouped = layout.get('barmode', 'group') == 'group'
+    for key, traces in subplots.items():
+        axis = axes[key] = _svg_axis(layout, [trace for _, trace in traces], area)
+        parts.extend(_svg_frame(axis, font_size))
+        for slot, (index, trace) in enumerate(traces):
+            parts.extend(_svg_bars(trace, axis, COLORS[index % len(COLORS)],
+                                   slot if grouped else 0, len(traces) if grouped else 1))
+    parts.extend(_svg_legend(layout, [trace for traces in subplots.values() for trace in traces], area,
+                             font_size))
+
+    for note in layout.get('annotations') or []:
+        parts.extend(_svg_annotation(note, area, axes, font_size))
+
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def _svg_color(color, default):
+    return _escape(color or default)
+
+
+def _escape(text):
+    return (u'{}'.format(text).replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+def _title_text(title):
+    if isinstance(title, dict):
+        return title.get('text')
+    return title
+
+
+def _svg_text(text, x, y, size, anchor='start', color='#444444'):
+    '''
+    Draws plotly's small HTML subset: <br> for new lines, <b> and <i>
+    '''
+    text = u'{}'.format(text)
+    weight = 'bold' if '<b>' in text else 'normal'
+    style = 'italic' if '<i>' in text else 'normal'
+    lines = re.split(r'<br\s*/?>', text)
+    lines = [re.sub(r'</?[bi]>', '', line) for line in lines]
+    y -= (len(lines) - 1) * size * 0.6
+    spans = ''.join('<tspan x="{:.1f}" dy="{}">{}</tspan>'.format(
+        x, 0 if number == 0 else size * 1.2, _escape(line)) for number, line in enumerate(lines))
+    return ('<text x="{:.1f}" y="{:.1f}" font-size="{}" font-weight="{}" font-style="{}" '
+            'text-anchor="{}" fill="{}" dominant-baseline="middle">{}</text>').format(
+        x, y, size, weight, style, anchor, color, spans)
+
+
+def _number(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return value
+
+
+def _svg_pie(trace, area, font_size):
+    left, top, width, height = area
+    labels = trace.get('labels') or []
+    values = [_number(value) or 0 for value in trace.get('values') or []]
+    total = sum(values)
+    if not total:
+        return []
+
+    cx, cy = left + width / 2.0, top + height / 2.0
+    radius = min(width, height) / 2.0 * 0.85
+    pull = _number(trace.get('pull')) or 0
+    # Plotly measures the rotation clockwise from twelve o'clock
+    angle = math.radians(_number(trace.get('rotation')) or 0) - math.pi / 2
+    clockwise = trace.get('direction') == 'clockwise'
+
+    parts = []
+    for index, (label, value) in enumerate(zip(labels, values)):
+        if not value:
+            continue
+        sweep = 2 * math.pi * value / total
+        end = angle + sweep if clockwise else angle - sweep
+        middle = (angle + end) / 2.0
+        ox, oy = math.cos(middle) * radius * pull, math.sin(middle) * radius * pull
+        start_x, start_y = cx + ox + radius * math.cos(angle), cy + oy + radius * math.sin(angle)
+        end_x, end_y = cx + ox + radius * math.cos(end), cy + oy + radius * math.sin(end)
+        if sweep >= 2 * math.pi - 1e-9:
+            parts.append('<circle cx="{:.1f}" cy="{:.1f}" r="{:.1f}" fill="{}"/>'.format(
+                cx, cy, radius, COLORS[index % len(COLORS)]))
+        else:
+            parts.append('<path d="M{:.1f},{:.1f} L{:.1f},{:.1f} A{:.1f},{:.1f} 0 {} {} {:.1f},{:.1f} Z" '
+                         'fill="{}" stroke="#ffffff"/>'.format(
+                             cx + ox, cy + oy, start_x, start_y, radius, radius,
+                             1 if sweep > math.pi else 0, 1 if clockwise else 0,
+                             end_x, end_y, COLORS[index % len(COLORS)]))
+
+        text = []
+        textinfo = trace.get('textinfo') or 'percent'
+        if 'label' in textinfo:
+            text.append(label)
+        if 'value' in textinfo:
+            text.append('{:,.0f}'.format(value))
+        if 'percent' in textinfo:
+            text.append('{:.1f}%'.format(100.0 * value / total))
+        parts.append(_svg_text('<br>'.join(text), cx + ox + math.cos(middle) * radius * 0.65,
+                               cy + oy + math.sin(middle) * radius * 0.65, font_size, 'middle'))
+        angle = end
+    return parts
+
+
+def _axis_ref(ref):
+    # 'x1' and 'x' both name the first axis
+    return ref[0] if ref[1:] in ('', '1') else ref
+
+
+class _Axis(object):
+    '''
+    Maps data coordinates of one subplot to pixels
+    '''
+
+    def __init__(self, box, categories, low, high, horizontal):
+        self.box = box
+        self.categories = categories
+        self.low = low
+        self.high = high
+        self.horizontal = horizontal
+
+    def value(self, value):
+        left, top, width, height = self.box
+        share = (value - self.low) / float(self.high - self.low)
+        if self.horizontal:
+            return left + share * width
+        return top + height - share * height
+
+    def category(self, label):
+        left, top, width, height = self.box
+        if label not in self.categories:
+            return None
+        band = (height if self.horizontal else width) / float(len(self.categories))
+        position = self.categories.index(label)
+        if self.horizontal:
+            return top + height - (position + 0.5) * band
+        return left + (position + 0.5) * band
+
+    def band(self):
+        left, top, width, height = self.box
+        return (height if self.horizontal else width) / float(max(len(self.categories), 1))
+
+
+def _svg_axis(layout, traces, area):
+    left, top, width, height = area
+
+    def domain(ref, letter):
+        suffix = _axis_ref(ref)[1:]
+        axis = layout.get(letter + 'axis' + suffix) or layout.get(letter + 'axis' + (suffix or '1')) or {}
+        return axis.get('domain') or [0, 1]
+
+    x_domain = domain(traces[0].get('xaxis', 'x'), 'x')
+    y_domain = domain(traces[0].get('yaxis', 'y'), 'y')
+    box = (left + x_domain[0] * width, top + (1 - y_domain[1]) * height,
+           (x_domain[1] - x_domain[0]) * width, (y_domain[1] - y_domain[0]) * height)
+
+    horizontal = traces[0].get('orientation') == 'h'
+    categories = []
+    values = []
+    for trace in traces:
+        for category in _bar_categories(trace, horizontal):
+            if category not in categories:
+                categories.append(category)
+        values.extend(_number(value) for value in (trace.get('x') if horizontal else trace.get('y')) or [])
+    values = [value for value in values if value is not None]
+    high = max(values + [0]) * 1.1 or 1
+    low = min(values + [0]) * 1.1
+    return _Axis(box, categories, low, high, horizontal)
+
+
+def _bar_categories(trace, horizontal):
+    return [u'{}'.format(category) for category in (trace.get('y') if horizontal else trace.get('x')) or []]
+
+
+def _svg_frame(axis, font_size):
+    left, top, width, height = axis.box
+    parts = ['<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" fill="none" '
+             'stroke="#dddddd"/>'.format(left, top, width, height)]
+    for label in axis.categories:
+        center = axis.category(label)
+        if axis.horizontal:
+            parts.append(_svg_text(label, left - 4, center, font_size, 'end'))
+        else:
+            parts.append(_svg_text(label, center, top + height + font_size, font_size, 'middle'))
+    return parts
+
+
+def _svg_bars(trace, axis, color, slot=0, slots=1):
+    '''
+    :param slot: which of the slots of each category the bars of this trace take
+    :param slots: how many bar traces share the categories of the subplot side by side
+    '''
+    values = (trace.get('x') if axis.horizontal else trace.get('y')) or []
+    thickness = axis.band() * 0.8 / slots
+    offset = (slot - (slots - 1) / 2.0) * thickness
+    zero = axis.value(0)
+    parts = []
+    for label, value in zip(_bar_categories(trace, axis.horizontal), values):
+        value = _number(value)
+        if value is None:
+            continue
+        end = axis.value(value)
+        if axis.horizontal:
+            center = axis.category(label) - offset
+            parts.append('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" fill="{}"/>'.format(
+                min(zero, end), center - thickness / 2, abs(end - zero), thickness, color))
+        else:
+            center = axis.category(label) + offset
+            parts.append('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" fill="{}"/>'.format(
+                center - thickness / 2, min(zero, end), thickness, abs(end - zero), color))
+    return parts
+
+
+def _svg_legend(layout, traces, area, font_size):
+    # Like plotly, shown right of the plot when there is more than one named trace
+    entries = [(trace.get('name'), COLORS[index % len(COLORS)]) for index, trace in traces
+               if trace.get('name') and trace.get('showlegend') is not False]
+    show = layout.get('showlegend')
+    if show is False or not entries or (show is None and len(entries) < 2):
+        return []
+    left, top, width, height = area
+    x = left + width + 10
+    parts = []
+    for number, (name, color) in enumerate(entries):
+        y = top + (number + 0.5) * font_size * 1.6
+        parts.append('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" fill="{}"/>'.format(
+            x, y - font_size / 2.0, font_size, font_size, color))
+        parts.append(_svg_text(name, x + font_size * 1.4, y, font_size))
+    return parts
+
+
+def _svg_annotation(note, area, axes, font_size):
+    left, top, width, height = area
+    size = (note.get('font') or {}).get('size') or font_size
+    color = (note.get('font') or {}).get('color') or '#444444'
+    text = note.get('text')
+    if text is None:
+        return []
+
+    if note.get('xref', 'paper') == 'paper' and note.get('yref', 'paper') == 'paper':
+        x = left + (_number(note.get('x')) or 0) * width
+        y = top + (1 - (_number(note.get('y')) or 0)) * height
+        anchor = {'left': 'start', 'right': 'end'}.get(note.get('xanchor'), 'middle')
+        # Subplot titles sit on top of their subplot
+        if note.get('yanchor') == 'bottom':
+            y -= size
+        return [_svg_text(text, x, y, size, anchor, color)]
+
+    axis = axes.get((_axis_ref(note.get('xref', 'x')), _axis_ref(note.get('yref', 'y'))))
+    if axis is None:
+        return []
+
+    category, value = (note.get('y'), note.get('x')) if axis.horizontal else (note.get('x'), note.get('y'))
+    center = axis.category(u'{}'.format(category))
+    value = _number(value)
+    if center is None or value is None:
+        return []
+    position = axis.value(value)
+    if axis.horizontal:
+        return [_svg_text(text, position, center, size, 'start', color)]
+    return [_svg_text(text, center, position, size, 'middle', color)]
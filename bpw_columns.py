@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import inspect
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import bpw_schema
+import bpw_graphs
+from bpw_cache import update_digest
+from bpw_metrics import timed
+from bpw_schema import EXPORTS, CATEGORY, TEXT, read_export
+
+# A per client store of parsed exports.  The first time an export is seen it
+# is read with read_export, the square footage of the projects is extracted
+# in place of their contract terms notes, which only hold that, and each
+# column is saved as a NumPy .npy file:
+#
+#   currency, date, SQFT:  the values (float64, datetime64)
+#   category, text:        the category codes, with the labels in a JSON file
+#
+# Later dashboards of the same export, for any start date, memory map those
+# files instead of parsing the CSV again.  Each export of a client is kept in
+# COLUMN_DIR/<client>/<export>/ together with a meta.json that records the
+# digest of the CSV it was made from and the version of the cleaning code.
+# The version is a hash of the source of bpw_schema and of the square footage
+# parser, so changing either one invalidates the stored files.
+
+# Bump this when the layout of the files changes
+FORMAT_VERSION = '2'
+
+SQFT = 'SQFT'
+
+# The free text the square footage is extracted from
+NOTES = 'CONTRACT TERMS NOTES'
+
+
+def cleaning_version():
+    '''
+    :return: a hex digest of the code that reads and cleans the exports
+    '''
+    digest = hashlib.sha1(FORMAT_VERSION.encode('utf-8'))
+    for source in [bpw_schema, bpw_graphs.extract_sqft, bpw_graphs._parse_sqft]:
+        digest.update(inspect.getsource(source).encode('utf-8'))
+    digest.update(bpw_graphs.SQFT_PATTERN.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def client_dir(client_name):
+    # Readable, and still unique when two names clean up the same way
+    safe = re.sub(r'[^\w.-]+', '_', client_name).strip('._')[:64]
+    return '{}-{}'.format(safe, hashlib.sha1(client_name.encode('utf-8')).hexdigest()[:8])
+
+
+class ColumnStore(object):
+
+    def __init__(self, column_dir):
+        '''
+        :param column_dir: directory where the parsed exports are kept
+        '''
+        self.column_dir = column_dir
+        self._version = None
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = cleaning_version()
+        return self._version
+
+    def _path(self, client_name, name):
+        return os.path.join(self.column_dir, client_dir(client_name), name)
+
+    def load(self, client_name, name, csv_file):
+        '''
+        :param client_name: name of the client
+        :param name: which export this is, one of the keys of bpw_schema.EXPORTS
+        :param csv_file: the path of the CSV export
+        :return: a pandas dataframe like read_export returns; the projects come with a SQFT column
+            instead of their notes
+        '''
+        digest = update_digest(hashlib.sha1(), csv_file).hexdigest()
+        path = self._path(client_name, name)
+
+        with timed('load_columns:' + name):
+            frame = self._read(path, name, digest)
+        if frame is not None:
+            return frame
+
+        with timed('read_csv:' + name):
+            frame = read_export(name, csv_file)
+        if name == 'projects':
+            frame[SQFT] = bpw_graphs.extract_sqft(frame[NOTES])
+            del frame[NOTES]
+        self._write(path, name, digest, frame)
+        return frame
+
+    def _read(self, path, name, digest):
+        try:
+            with open(os.path.join(path, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+        except (IOError, ValueError):
+            return None
+        if meta.get('digest') != digest or meta.get('version') != self.version:
+            return None
+
+        columns = {}
+        try:
+            for number, (column, kind) in enumerate(meta['columns']):
+                values = np.load(os.path.join(path, '{}.npy'.format(number)), mmap_mode='r')
+                if kind in (CATEGORY, TEXT):
+                    with open(os.path.join(path, '{}.json'.format(number))) as labels_file:
+                        labels = json.load(labels_file)
+                    if kind == CATEGORY:
+                        values = pd.Categorical.from_codes(values, labels)
+                    else:
+                        # Free text goes back to strings, with NaN where it was missing
+                        values = np.array(labels + [float('nan')], dtype=object).take(values)
+                columns[column] = values
+        except (IOError, ValueError):
+            # Replaced or removed while being read
+            return None
+        return pd.DataFrame(columns, columns=[column for column, _ in meta['columns']], copy=False)
+
+    def _write(self, path, name, digest, frame):
+        kinds = [(column, kind) for column, kind in EXPORTS[name]['columns'].items() if column in frame]
+        if SQFT in frame:
+            kinds.append((SQFT, None))
+
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        tmp_path = tempfile.mkdtemp(prefix='.{}.'.format(name), dir=parent)
+        try:
+            for number, (column, kind) in enumerate(kinds):
+                values = frame[column]
+                if kind in (CATEGORY, TEXT):
+                    categorical = values.astype('category').values
+                    np.save(os.path.join(tmp_path, '{}.npy'.format(number)), np.asarray(categorical.codes))
+                    with open(os.path.join(tmp_path, '{}.json'.format(number)), 'w') as labels_file:
+                        json.dump(list(categorical.categories), labels_file)
+                else:
+                    np.save(os.path.join(tmp_path, '{}.npy'.format(number)), np.asarray(values.values))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+                json.dump(dict(digest=digest, version=self.version, rows=len(frame), columns=kinds), meta_file)
+
+            # Swap the new files in; maps of the old ones stay valid until closed
+            old_path = None
+            if os.path.isdir(path):
+                old_path = tempfile.mkdtemp(prefix='.{}.old.'.format(name), dir=parent)
+                os.rename(path, os.path.join(old_path, name))
+            os.rename(tmp_path, path)
+            if old_path is not None:
+                shutil.rmtree(old_path, ignore_errors=True)
+        except (IOError, OSError):
+            # Another worker wrote the same export first; the store is only a cache
+            shutil.rmtree(tmp_path, ignore_errors=True)
@@ -1,25 +1,40 @@
 import re
-import os
+from functools import partial
+from collections import Counter
+
 import pandas as pd
-from numpy import array, isfinite
+from numpy import array, append, isfinite
 
-import plotly.plotly as py
 import plotly.tools as tools
 import plotly.graph_objs as go
 
+from bpw_charts import render_chart
+from bpw_metrics import timed, instrumented
+from bpw_tasks import TaskGraph
+from bpw_schema import read_export
+from bpw_aggregate import (LEAK_CALLS, COMPLETED, SQFT_LABELS, ALL_BANDS, ALL_YEARS, mean, merged, roof_totals,
+                           worder_totals, receivable_totals, project_totals, cost_totals, trend_totals,
+                           index_totals)
+
+# Names of the items of the list returned by dashboard, used by the JSON API; the
+# cost comparison is added by the app, see cost_comparison
+DASH_FIELDS = ['inspection_chart', 'warranty_calls', 'billed_calls', 'avg_price_per_call', 'repairs',
+               'avg_price_per_repair', 'avg_cost_per_project', 'avg_spread_per_project', 'projects_completed',
+               'savings', 'project_chart', 'avg_cost_per_inspection', 'trend_chart', 'numbers', 'cost_comparison']
 
-USER_NAME = os.environ['PLOTLY_USER_NAME']
-API_KEY = os.environ['PLOTLY_API_KEY']
-py.sign_in(username=USER_NAME, api_key=API_KEY)
+# The items that are chart references
+CHART_FIELDS = ['inspection_chart', 'project_chart', 'trend_chart']
 
 # This is a function that will process the incoming files and provide the graphs and information
 # that is required for the dashboard
 
-def dashboard(roofs, worders, projects, receivables, start_date='2016-01-01'):
+@instrumented('dashboard')
+def dashboard(roofs, worders, projects, receivables, start_date='2016-01-01', aggregates=None, client_name=None,
+              columns=None, chunksize=None, cost_index=None):
     # type: (file, file, file, file, file) -> dictionary
     # Dashboard reads 4 CSV files and given a start_date and end_date
     # Returns in a dictionary:
-    # 0)  The URL of the first plot: first_plot_url
+    # 0)  The chart reference of the first plot: first_plot_url
     # 1)  A string containing the number of calls and percentage handled by warranty
     # 2)  The number of billed calls
     # 3)  The average price per call
@@ -29,8 +44,10 @@ def dashboard(roofs, worders, projects, receivables, start_date='2016-01-01'):
     # 7)  The average spread per project
     # 8)  The number of projects completed
     # 9)  A savings text
-    # 10) The URL of the second plot: second_plot_url
+    # 10) The chart reference of the second plot: second_plot_url
     # 11) The average cost per inspection
+    # 12) The chart reference of the year by year trend: trend_chart_url
+    # 13) The numbers of 1) to 9) and 11) unformatted, see dashboard_numbers
 
     # First we read in the 4 files that we are going to need to make the report
 
@@ -40,35 +57,233 @@ def dashboard(roofs, worders, projects, receivables, start_date='2016-01-01'):
     :param worders: csv file containing work order report
     :param projects: csv file containing project information
     :param receivables: csv file containing receivables info
+    :param aggregates: a bpw_incremental.AggregateStore for the incremental mode, where
+        the files only hold the rows that are new or changed since the last dashboard
+        of the client and any of them may be None
+    :param client_name: the client the aggregates or the parsed exports are kept for
+    :param columns: a bpw_columns.ColumnStore, exports parsed before for the client are loaded from it
+    :param chunksize: read the files this many rows at a time, so the memory used doesn't grow with them
+    :param cost_index: a bpw_index.CostIndex, the projects of the client replace what it had there before;
+        the comparison with the other clients is made by cost_comparison, it changes with them
     '''
 
-    roofs = pd.read_csv(roofs)
-    worders = pd.read_csv(worders)
-    projects = pd.read_csv(projects)
-    receivables = pd.read_csv(receivables)
+    # Only the columns declared in bpw_schema are read, and the money amounts,
+    # dates and statuses are converted as they are read
+
+    if aggregates is not None:
+        # Only the delta is read and folded into the stored totals of the client
+        frames = {}
+        for name, csv_file in [('roofs', roofs), ('worders', worders), ('projects', projects),
+                               ('receivables', receivables)]:
+            if csv_file is not None:
+                with timed('read_csv:' + name):
+                    frames[name] = read_export(name, csv_file, with_key=True)
+        totals = aggregates.update(client_name, start_date, frames)
+        if cost_index is not None:
+            cost_index.update(client_name, totals)
+        return dashboard_from_totals(totals)
+
+    if chunksize is not None:
+        totals = Counter()
+        for name, csv_file in [('roofs', roofs), ('worders', worders), ('projects', projects),
+                               ('receivables', receivables)]:
+            with timed('read_chunks:' + name):
+                chunks = read_export(name, csv_file, chunksize=chunksize)
+                totals.update(merged(partial(export_totals, name), chunks, start_date))
+        if cost_index is not None:
+            cost_index.update(client_name, totals)
+        return dashboard_from_totals(totals)
+
+    # The four files are read at the same time, and each number and chart is
+    # made as soon as the files it comes from are read (see bpw_tasks)
+    with TaskGraph('dashboard') as graph:
+        for name, csv_file in [('roofs', roofs), ('worders', worders), ('projects', projects),
+                               ('receivables', receivables)]:
+            graph.add(name, load_export, args=(name, csv_file, client_name, columns))
+
+        graph.add('count_conditions', count_conditions, 'roofs')
+        graph.add('pie_chart', pie_chart, 'count_conditions', unpack=True, process=True)
+        graph.add('upper_right_totals', upper_right_totals, 'worders', 'receivables', 'projects',
+                  args=(start_date,))
+        graph.add('upper_right_stats', upper_right_from_totals, 'upper_right_totals')
+        graph.add('dashboard_numbers', dashboard_numbers, 'upper_right_totals')
+        graph.add('second_graph_numbers', second_graph_numbers, 'projects', args=(start_date,))
+        graph.add('project_overlay_tearoff', project_overlay_tearoff, 'projects', args=(start_date,))
+        graph.add('second_graph', second_graph, 'second_graph_numbers', 'project_overlay_tearoff', process=True)
+        graph.add('avg_cost_inspection', avg_cost_inspection, 'receivables')
+        graph.add('trend_windows', trend_windows, 'projects')
+        graph.add('trend_chart', trend_chart, 'trend_windows', process=True)
+        if cost_index is not None:
+            graph.add('cost_index', lambda projects: cost_index.update(client_name, project_index_totals(projects)),
+                      'projects')
+
+    dashboard_values = [graph.get('pie_chart')]
+
+    dashboard_values = dashboard_values + graph.get('upper_right_stats')
+
+    dashboard_values = dashboard_values + [graph.get('second_graph')] +\
+                       [graph.get('avg_cost_inspection')] + [graph.get('trend_chart')] +\
+                       [graph.get('dashboard_numbers')]
+
+    if cost_index is not None:
+        graph.get('cost_index')
 
-    # We process the files to remove some commas from numbers
+    return dashboard_values
 
-    receivables["INVOICE AMOUNT"] = receivables["INVOICE AMOUNT"].map(lambda x: x.replace(",", ""))
-    projects[["BID AMOUNT"]] = projects[["BID AMOUNT"]].replace('[\$,]', '', regex=True).astype("float64")
-    projects["YEAR"] = pd.to_datetime(projects["STATUSDATE"]).dt.year
-    projects["STATUSDATE"] = pd.to_datetime(projects["STATUSDATE"])
 
-    dashboard_values = [pie_chart_url(roofs)]
+def load_export(name, csv_file, client_name=None, columns=None):
+    '''
+    :param name: which export this is, one of the keys of bpw_schema.EXPORTS
+    :param csv_file: a path or file object of the CSV export
+    :param client_name: the client the parsed exports are kept for
+    :param columns: a bpw_columns.ColumnStore, or None to read the file
+    :return: a pandas dataframe from read_export; the projects come with their
+        year and square footage instead of the contract terms notes
+    '''
+    if columns is not None:
+        frame = columns.load(client_name, name, csv_file)
+    else:
+        with timed('read_csv:' + name):
+            frame = read_export(name, csv_file)
+    if name == 'projects':
+        frame["YEAR"] = frame["STATUSDATE"].dt.year
+        # The notes are the largest column and only hold the square footage,
+        # the column store keeps the square footage without them
+        if 'SQFT' not in frame:
+            frame['SQFT'] = extract_sqft(frame['CONTRACT TERMS NOTES'])
+            del frame['CONTRACT TERMS NOTES']
+    return frame
+
+
+def export_totals(name, frame, start_date):
+    '''
+    :param name: which export the frame is, one of the keys of bpw_schema.EXPORTS
+    :param frame: a pandas dataframe from read_export
+    :param start_date: start date of the report
+    :return: a Counter with everything the dashboard needs from those rows
+    '''
+    if name == 'roofs':
+        return roof_totals(frame)
+    if name == 'worders':
+        return worder_totals(frame)
+    if name == 'receivables':
+        return receivable_totals(frame)
+    totals = project_totals(frame, start_date)
+    totals.update(project_cost_totals(frame, start_date))
+    totals.update(trend_totals(frame))
+    totals.update(project_index_totals(frame))
+    return totals
+
+
+@instrumented('dashboard_from_totals')
+def dashboard_from_totals(totals):
+    '''
+    :param totals: a Counter with the totals of all four exports, see export_totals
+    :return: the same list as dashboard
+    '''
+    # The numbers are quick, the three charts are drawn at the same time
+    with TaskGraph('dashboard_from_totals') as graph:
+        graph.add('pie_chart', pie_chart, args=conditions_from_totals(totals), process=True)
+        graph.add('second_graph', second_graph, process=True,
+                  args=(second_graph_from_totals(totals), overlay_tearoff_from_totals(totals)))
+        graph.add('trend_chart', trend_chart, args=(trend_from_totals(totals, cumulative=False),), process=True)
+    return ([graph.get('pie_chart')] + upper_right_from_totals(totals) +
+            [graph.get('second_graph'), inspection_from_totals(totals), graph.get('trend_chart'),
+             dashboard_numbers(totals)])
 
-    dashboard_values = dashboard_values + upper_right_stats(worders, receivables, projects, start_date)
 
-    dashboard_values = dashboard_values + [second_graph_url(projects, start_date)] +\
-                       [avg_cost_inspection(receivables)]
+# The keys of the totals that depend on the start date, and the trend totals they are made of
+SINCE_KEYS = {'status_since': 'trend_status', 'completed': 'trend_completed'}
 
-    #dashboard_values.update(upper_right_stats(worders, receivables, projects, start_date))
 
-    return dashboard_values
+def trend_from_totals(totals, cumulative=True):
+    '''
+    :param totals: a Counter with trend totals, see bpw_aggregate.trend_totals
+    :param cumulative: True for the totals since the start of each period, like a dashboard
+        with that start date, False for the totals within each period
+    :return: a list of (period, totals) in the order of the periods, where the totals can
+        be formatted with upper_right_from_totals and second_graph_from_totals
+    '''
+    by_period = {}
+    for key, value in totals.items():
+        if key[0] in ('trend_status', 'trend_completed'):
+            by_period.setdefault(key[1], Counter())[(key[0],) + key[2:]] = value
+    base = Counter(dict((key, value) for key, value in totals.items()
+                        if key[0] not in SINCE_KEYS and key[0] not in ('trend_status', 'trend_completed')))
+
+    windows = []
+    running = Counter()
+    # From the last period back, so each one adds up everything after it
+    for period in sorted(by_period, reverse=True):
+        if not cumulative:
+            running = Counter()
+        for metric, trend_metric in SINCE_KEYS.items():
+            for key, value in by_period[period].items():
+                if key[0] == trend_metric:
+                    running[(metric,) + key[1:]] += value
+        window = base.copy()
+        window.update(running)
+        windows.append((period, window))
+    return windows[::-1]
+
+
+@instrumented('trend_chart_url')
+def trend_chart_url(projects):
+    '''
+    :param projects: a pandas dataframe of projects
+    :return: a chart reference for the year by year trend (see bpw_charts)
+    '''
+    return trend_chart(trend_windows(projects))
+
+
+def trend_windows(projects):
+    '''
+    :param projects: a pandas dataframe of projects
+    :return: the windows of the trend chart, see trend_from_totals
+    '''
+    return trend_from_totals(trend_totals(projects), cumulative=False)
+
+
+def trend_chart(windows):
+    '''
+    :param windows: the list from trend_from_totals
+    :return: a chart reference for the trend chart (see bpw_charts)
+    '''
+    labels = [str(period) for period, _ in windows]
+    completed = [totals[('completed', 'count')] for _, totals in windows]
+    # Rounded to cents so the chart is the same however the totals were added up
+    avg_cost = [round(mean(totals[('completed', 'bid')], totals[('completed', 'count')]), 2)
+                for _, totals in windows]
+    avg_spread = [round(mean(totals[('completed', 'spread')], totals[('completed', 'spreads')]), 2)
+                  for _, totals in windows]
+    proposals = [totals[('status_since', '(3) PROPOSAL PENDING')] for _, totals in windows]
+    rejected = [totals[('status_since', '(5) PROPOSAL REJECTED')] for _, totals in windows]
+
+    fig = tools.make_subplots(rows=1, cols=3, print_grid=False,
+                              subplot_titles=["<b>PROJECTS COMPLETED</b>", "<b>AVERAGE COST AND SPREAD</b>",
+                                              "<b>PROPOSALS</b>"])
+    fig.append_trace(go.Bar(x=labels, y=completed, name='Completed'), 1, 1)
+    fig.append_trace(go.Bar(x=labels, y=avg_cost, name='Avg Cost'), 1, 2)
+    fig.append_trace(go.Bar(x=labels, y=avg_spread, name='Avg Spread'), 1, 2)
+    fig.append_trace(go.Bar(x=labels, y=proposals, name='Pending'), 1, 3)
+    fig.append_trace(go.Bar(x=labels, y=rejected, name='Rejected'), 1, 3)
+
+    fig['layout'].update(title='<b>PROJECTS BY YEAR</b>',
+                         barmode='group',
+                         paper_bgcolor='rgb(248, 248, 255)',
+                         plot_bgcolor='rgb(248, 248, 255)',
+                         font=dict(size=10),
+                         height=400,
+                         width=1000,
+                         titlefont=dict(size=18))
+
+    return render_chart(fig, 'Project Trend')
 
 
+@instrumented('count_conditions')
 def count_conditions(roofs):
     '''
-    :param roofs: a pandas dataframe of roof conditions
+    :param roofs: a pandas dataframe of roof conditions, or an iterable of chunks of one
     :return: a tuple containing a list of labels and a list of values
     '''
 
@@ -77,24 +292,35 @@ def count_conditions(roofs):
     ### We will read the data from the roof inspections and count
     ### each of the different types of roof conditions that exists
 
-    # First let's filter roofs whose condition are NaN
+    return conditions_from_totals(merged(roof_totals, roofs))
 
-    roofs = roofs[pd.notnull(roofs["Roof Condition"])]
-    conditions = roofs['Roof Condition']
 
+def conditions_from_totals(totals):
+    '''
+    :param totals: a Counter from bpw_aggregate.roof_totals
+    :return: a tuple containing a list of labels and a list of values
+    '''
     labels = ["Excellent", "Good", "Fair", "Poor", "Bad"]
-    values = [sum(conditions == label) for label in labels]
+    values = [totals[('condition', label)] for label in labels]
     return labels, values
 
 
+@instrumented('pie_chart_url')
 def pie_chart_url(roofs):
     '''
     :param roofs: a csv file with roof information
-    :return: a url for a plotly pie chart
+    :return: a chart reference for the pie chart (see bpw_charts)
     '''
 
-    labels, values = count_conditions(roofs)
+    return pie_chart(*count_conditions(roofs))
+
 
+def pie_chart(labels, values):
+    '''
+    :param labels: the roof conditions
+    :param values: the number of roofs in each condition
+    :return: a chart reference for the pie chart (see bpw_charts)
+    '''
     fig = {
         'data': [{'labels': labels,
                   'values': values,
@@ -111,26 +337,36 @@ def pie_chart_url(roofs):
     fig['layout'].update(paper_bgcolor='rgb(248, 248, 255)',
                          plot_bgcolor='rgb(248, 248, 255)')
 
-    return py.plot(fig, filename='BPW Pie Chart', auto_open=False, )
+    return render_chart(fig, 'BPW Pie Chart')
 
 
+@instrumented('avg_cost_inspection')
 def avg_cost_inspection(receivables):
     '''
-    :param receivables: a pandas dataframe of receivables
+    :param receivables: a pandas dataframe of receivables, or an iterable of chunks of one
     :return: the average cost of the inspection receivable
     '''
 
-    inspections = receivables[receivables["WORKORDER TYPE"] == "Inspection"]
+    return inspection_from_totals(merged(receivable_totals, receivables))
+
 
+def inspection_from_totals(totals):
+    '''
+    :param totals: a Counter from bpw_aggregate.receivable_totals
+    :return: the average cost of the inspection receivable
+    '''
     return "Average cost for each inspection: ${:,.2f}".format(
-        inspections["INVOICE AMOUNT"].astype("float64").mean())
+        mean(totals[('worktype_total', 'Inspection')], totals[('worktype_amounts', 'Inspection')]))
 
 
+@instrumented('upper_right_stats')
 def upper_right_stats(worders, receivables, projects, start_date):
     '''
     :rtype: dict
     :param worders: a pandas frame of work orders
     :param receivables: a pandas frame of receivables
+    :param projects: a pandas frame of projects
+        (each of the frames can also be an iterable of chunks of one)
     :param start_date: start date of the report
     :return: a dictionary with
         # 2)  A string containing the number of calls and percentage handled by warranty
@@ -146,109 +382,145 @@ def upper_right_stats(worders, receivables, projects, start_date):
 
     # Part 2: Upper Right Hand Corner of Report
 
-    worders = worders[pd.notnull(worders["SUBTYPE"])]
-    worders = worders[worders["STATUS"] == "COMPLETED"]
-    leaks = pd.concat(
-        [worders[worders["SUBTYPE"] == "Leak Call "], worders[worders["SUBTYPE"] == "Leak Call - Emergency"]])
-
-    # Number of calls handled by warranty
-    warranty = sum(leaks['FINANCIAL_RESPONSIBILITY'] == 'INTERNAL CHARGE')
-    warranty += sum(worders["SUBTYPE"] == "Warranty - Leak Call")
-
-    # Average price per call
-    billed_calls = pd.concat([receivables[receivables["WORKORDER SUBTYPE"] == "Leak Call "],
-                              receivables[receivables["WORKORDER SUBTYPE"] == "Leak Call - Emergency"]])
-    avg_price_call = billed_calls["INVOICE AMOUNT"].astype("float64").mean()
-    avg_price_call = "${:,.2f}".format(avg_price_call)
-
-    # Number of billed calls
-    num_bill_calls = billed_calls.shape[0]
-
-    # Number of repair calls
-
-    repairs = receivables[receivables["WORKORDER SUBTYPE"] == "Repairs "]
-    num_repairs = repairs.shape[0]
+    return upper_right_from_totals(upper_right_totals(worders, receivables, projects, start_date))
 
-    # Average price per repair job
 
-    avg_repairs = repairs["INVOICE AMOUNT"].astype("float64").mean()
-    avg_repairs = "${:,.2f}".format(avg_repairs)
-
-    percent_warranty = " ({:,.0f}%)".format(warranty * 100 / float(num_bill_calls + warranty))
-
-    # Now to get the spread of the projects
-    # We'll have to filter the completed projects to be
-    # correction to "(7) COMPLETED"
-    completed = pd.concat([projects[projects["STATUS"] == "(8) COMPLETED"],
-                          projects[projects["STATUS"] == "(7) COMPLETED PENDING W.D.I."]])
-    mask = (completed["STATUSDATE"] > start_date) & (completed["BID AMOUNT"] > 1)
-    completed = completed.loc[mask]
+@instrumented('upper_right_totals')
+def upper_right_totals(worders, receivables, projects, start_date):
+    '''
+    :param worders: a pandas frame of work orders
+    :param receivables: a pandas frame of receivables
+    :param projects: a pandas frame of projects
+        (each of the frames can also be an iterable of chunks of one)
+    :param start_date: start date of the report
+    :return: a Counter with the worder, receivable and project totals
+    '''
+    totals = merged(worder_totals, worders)
+    totals.update(merged(receivable_totals, receivables))
+    totals.update(merged(project_totals, projects, start_date))
+    return totals
 
-    # Number of Projects completed in 2016
 
-    num_completed = completed.shape[0]
+def upper_right_numbers(totals):
+    '''
+    :param totals: a Counter with the worder, receivable and project totals
+    :return: a dictionary with the numbers of the list described in upper_right_stats
+    '''
 
+    # Number of calls handled by warranty
+    warranty = sum(totals[('internal_charge', subtype)] for subtype in LEAK_CALLS)
+    warranty += totals[('completed_subtype', "Warranty - Leak Call")]
 
-    # Now to calculate the spread
+    # Number of billed calls
+    num_bill_calls = sum(totals[('subtype_invoices', subtype)] for subtype in LEAK_CALLS)
 
-    completed["SPREAD"] = completed["BID AMOUNT"] - completed["REVISEDCONTRACTAMOUNT"]
-    avg_spread = completed["SPREAD"].mean()
-    avg_spread_text = "${:,.0f}".format(avg_spread)
+    # Average price per call
+    billed_total = sum(totals[('subtype_total', subtype)] for subtype in LEAK_CALLS)
+    billed_amounts = sum(totals[('subtype_amounts', subtype)] for subtype in LEAK_CALLS)
+
+    # Now to get the spread of the projects completed after the start date
+    # (correction to "(7) COMPLETED")
+
+    num_completed = totals[('completed', 'count')]
+    avg_spread = mean(totals[('completed', 'spread')], totals[('completed', 'spreads')])
+
+    return dict(
+        warranty_calls=warranty,
+        warranty_percent=mean(warranty * 100, num_bill_calls + warranty),
+        billed_calls=num_bill_calls,
+        avg_price_per_call=mean(billed_total, billed_amounts),
+        # Number of repair calls and average price per repair job
+        repairs=totals[('subtype_invoices', "Repairs ")],
+        avg_price_per_repair=mean(totals[('subtype_total', "Repairs ")], totals[('subtype_amounts', "Repairs ")]),
+        avg_cost_per_project=mean(totals[('completed', 'bid')], num_completed),
+        avg_spread_per_project=avg_spread,
+        projects_completed=num_completed,
+        # Now to calculate savings
+        savings=num_completed * avg_spread,
+    )
 
-    # Now to calculate savings
-    savings = num_completed * avg_spread
-    savings_text = avg_spread_text + ' = ${:,.0f} potential savings'.format(savings)
 
-    avg_cost = completed["BID AMOUNT"].mean()
-    avg_cost_text = "${:,.0f}".format(avg_cost)
+def upper_right_from_totals(totals):
+    '''
+    :param totals: a Counter with the worder, receivable and project totals
+    :return: the list described in upper_right_stats
+    '''
+    numbers = upper_right_numbers(totals)
+    avg_spread_text = "${:,.0f}".format(numbers['avg_spread_per_project'])
 
     return [
-            str(warranty) + percent_warranty,
-            str(num_bill_calls),
-            avg_price_call,
-            num_repairs,
-            avg_repairs,
-            avg_cost_text,
+            str(numbers['warranty_calls']) + " ({:,.0f}%)".format(numbers['warranty_percent']),
+            str(numbers['billed_calls']),
+            "${:,.2f}".format(numbers['avg_price_per_call']),
+            numbers['repairs'],
+            "${:,.2f}".format(numbers['avg_price_per_repair']),
+            "${:,.0f}".format(numbers['avg_cost_per_project']),
             avg_spread_text,
-            str(num_completed),
-            savings_text
+            str(numbers['projects_completed']),
+            avg_spread_text + ' = ${:,.0f} potential savings'.format(numbers['savings'])
             ]
 
 
+# The numbers of dashboard_numbers that are counts, the others are amounts or percents
+COUNT_NUMBERS = ['warranty_calls', 'billed_calls', 'repairs', 'projects_completed']
+
+
+def dashboard_numbers(totals):
+    '''
+    :param totals: a Counter with the worder, receivable and project totals
+    :return: a dictionary with the numbers behind the text of the dashboard, for the JSON API;
+        amounts and percents are rounded to two decimals and an average of nothing is None
+    '''
+    numbers = upper_right_numbers(totals)
+    numbers['avg_cost_per_inspection'] = mean(totals[('worktype_total', 'Inspection')],
+                                              totals[('worktype_amounts', 'Inspection')])
+    for name, value in numbers.items():
+        if name in COUNT_NUMBERS:
+            numbers[name] = int(value)
+        else:
+            numbers[name] = round(float(value), 2) if isfinite(value) else None
+    return numbers
+
+
+@instrumented('second_graph_numbers')
 def second_graph_numbers(projects, start_date='2016-01-01'):
     '''
     :param projects:
     :param start_date:
     :return: status_labels, status_counts, total_bought, total_projects:
     '''
-    # We have the number of projects completed for the above
+    return second_graph_from_totals(project_totals(projects, start_date))
+
+
+def second_graph_from_totals(totals):
+    '''
+    :param totals: a Counter from bpw_aggregate.project_totals
+    :return: status_labels, status_counts, total_bought, total_projects:
+    '''
+    # 'status_since' counts the projects since the start date, 'status' all of them
 
-    # 1) The Number of completed is num_completed
-    projects_now = projects[projects['STATUSDATE'] >= start_date]
+    # 1) The Number of completed
     # Correction to '(7) COMPLETED', '(8) ON-HOLD'
-    # num_completed = sum(projects_now['STATUS'] == '(7) COMPLETED')
-    num_completed = sum(projects_now['STATUS'] == '(8) COMPLETED')
-    num_completed += sum(projects_now['STATUS'] == '(7) COMPLETED PENDING W.D.I.')
+    num_completed = sum(totals[('status_since', status)] for status in COMPLETED)
 
     # 2) Now let's calculate in-progress projects
 
-    in_progress = projects[projects['STATUS'] == '(6) IN-PROGRESS']
-    num_in_progress = in_progress.shape[0]
+    num_in_progress = totals[('status', '(6) IN-PROGRESS')]
 
     # 3) Now for the number rejected
 
-    rejected = sum(projects_now['STATUS'] == '(5) PROPOSAL REJECTED')
+    rejected = totals[('status_since', '(5) PROPOSAL REJECTED')]
 
     # 4,5,6) Now for the number on-hold, approved, proposals pending
 
-    on_hold = sum(projects['STATUS'] == '(9) ON-HOLD')
-    approved = sum(projects['STATUS'] == '(4) APPROVED')
-    proposal = sum(projects_now['STATUS'] == '(3) PROPOSAL PENDING')
+    on_hold = totals[('status', '(9) ON-HOLD')]
+    approved = totals[('status', '(4) APPROVED')]
+    proposal = totals[('status_since', '(3) PROPOSAL PENDING')]
 
     # 7,8) Preparing, Bidding
 
-    preparing = sum(projects_now['STATUS'] == '(1)PREPARING SPECFICIATION')
-    bidding = sum(projects['STATUS'] == '(2) BIDDING')
+    preparing = totals[('status_since', '(1)PREPARING SPECFICIATION')]
+    bidding = totals[('status', '(2) BIDDING')]
 
     # Now let's put the labels and the amounts in a nice lists
 
@@ -263,6 +535,7 @@ def second_graph_numbers(projects, start_date='2016-01-01'):
     return status_labels, status_counts, total_bought, total_projects
 
 
+@instrumented('project_overlay_tearoff')
 def project_overlay_tearoff(projects, start_date='2016-01-01'):
     '''
     :param projects:
@@ -270,56 +543,125 @@ def project_overlay_tearoff(projects, start_date='2016-01-01'):
     :return:
     '''
 
-    mask = (projects['STATUSDATE'] >= start_date) & \
-           (projects['STATUS'] != "(3) PROPOSAL PENDING") & \
-           (pd.notnull(projects["CONTRACT TERMS NOTES"]))
+    return overlay_tearoff_from_totals(project_cost_totals(projects, start_date))
 
-    # projects = projects[projects['STATUSDATE'] >= start_date]
-    # projects = projects[projects['STATUS'] != "(3) PROPOSAL PENDING"]
-    # projects = projects[pd.notnull(projects["CONTRACT TERMS NOTES"])]
 
-    projects = projects.loc[mask]
-    projects['SQFT'] = projects['CONTRACT TERMS NOTES'].map(add_sqft)
-    projects = projects[projects["SQFT"] > 100]
+def project_cost_totals(projects, start_date='2016-01-01'):
+    '''
+    :param projects: a pandas dataframe of projects
+    :param start_date: start date of the report
+    :return: a Counter from bpw_aggregate.cost_totals of the projects since start_date
+        with a square footage in their notes
+    '''
+    projects, sqft = costed_projects(projects, projects['STATUSDATE'] >= start_date)
+    return cost_totals(projects, sqft)
 
-    proj_type = projects.groupby("TYPE").sum()
-    proj_type["AVGCOSTSQFT"] = proj_type["REVISEDCONTRACTAMOUNT"] / proj_type["SQFT"]
 
-    proj_values = [round(item, 2) for item in proj_type['AVGCOSTSQFT']]
-    proj_labels = [item for item in proj_type.index]
+def project_index_totals(projects):
+    '''
+    :param projects: a pandas dataframe of projects
+    :return: a Counter from bpw_aggregate.index_totals of the projects of any date
+        with a square footage in their notes
+    '''
+    projects, sqft = costed_projects(projects)
+    return index_totals(projects, sqft)
 
-    # Now we want to separate the tear off and overlay into groups
-    sqft_labels = ["0-10,000", "10,000-25,000", "25,000-50,000", "50,000 and up"]
-    factor = pd.cut(projects['SQFT'], bins=[0, 10000, 25000, 50000, 9000000],
-                    labels=sqft_labels)
-    proj_type_sqft = projects.groupby(['TYPE', factor]).sum()
-    proj_type_sqft['AVGCOSTSQFT'] = proj_type_sqft['REVISEDCONTRACTAMOUNT'] / proj_type_sqft['SQFT']
-
-    if 'Reroof (Overlay)' in proj_type.index:
-        overlay_group = proj_type_sqft.ix["Reroof (Overlay)"]
-        overlay_values = [round(overlay_group.ix[label, "AVGCOSTSQFT"], 2) for label in sqft_labels]
-    else:
-        overlay_values = [0, 0, 0, 0]
 
-    if 'Reroof (Tear-off)' in proj_type.index:
-        tear_off_group = proj_type_sqft.ix["Reroof (Tear-off)"]
-        tear_off_values = [round(tear_off_group.ix[label, "AVGCOSTSQFT"], 2) for label in sqft_labels]
+# What bpw_aggregate.cost_totals and index_totals read of the projects
+COSTED_COLUMNS = ['TYPE', 'REVISEDCONTRACTAMOUNT', 'STATUSDATE']
+
+
+def costed_projects(projects, mask=True):
+    '''
+    :param projects: a pandas dataframe of projects
+    :param mask: which of them to consider
+    :return: the projects that aren't proposals and have a square footage in their notes, and that square footage;
+        only the columns of the cost totals are kept
+    '''
+    mask = mask & (projects['STATUS'] != "(3) PROPOSAL PENDING")
+    # Projects from load_export come with the square footage already extracted
+    if 'SQFT' in projects:
+        sqft = projects['SQFT']
     else:
-        tear_off_values = [0, 0, 0, 0]
+        sqft = extract_sqft(projects['CONTRACT TERMS NOTES'].where(mask))
+    # Missing notes have no square footage, so they aren't large
+    mask = mask & (sqft > 100)
+
+    return projects.loc[mask, COSTED_COLUMNS], sqft[mask]
+
+
+# The project types the dashboard compares with the other clients
+COMPARED_TYPES = [('Reroof (Tear-off)', 'Tear-off'), ('Reroof (Overlay)', 'Overlay')]
+
+
+def cost_comparison(cost_index, client_name):
+    '''
+    :param cost_index: a bpw_index.CostIndex the client is in
+    :param client_name: name of the client
+    :return: a list of lines comparing the cost per square foot of the client with the
+        other clients, for each size band of the tear-offs and overlays
+    '''
+    keys = [(project_type, band, ALL_YEARS) for project_type, _ in COMPARED_TYPES
+            for band in [ALL_BANDS] + SQFT_LABELS]
+    compared = cost_index.compare(client_name, keys)
+    lines = []
+    for key in keys:
+        if key not in compared:
+            continue
+        own, others, clients = compared[key]
+        size = 'all sizes' if key[1] == ALL_BANDS else key[1] + ' sq ft'
+        lines.append('{}, {}: ${:,.2f} against ${:,.2f} for {} other client{}'.format(
+            dict(COMPARED_TYPES)[key[0]], size, own, others, clients, '' if clients == 1 else 's'))
+    return lines
+
+
+def overlay_tearoff_from_totals(totals):
+    '''
+    :param totals: a Counter from bpw_aggregate.cost_totals
+    :return: proj_labels, proj_values, sqft_labels, overlay_values, tear_off_values
+    '''
+
+    def cost_per_sqft(revised, sqft):
+        return round(revised / sqft, 2) if sqft else float('nan')
+
+    proj_labels = sorted(key[1] for key in totals if key[0] == 'type_sqft')
+    proj_values = [cost_per_sqft(totals[('type_revised', label)], totals[('type_sqft', label)])
+                   for label in proj_labels]
+
+    # Now we want to separate the tear off and overlay into groups
+    sqft_labels = list(SQFT_LABELS)
+
+    def band_values(project_type):
+        if project_type not in proj_labels:
+            return [0, 0, 0, 0]
+        return [cost_per_sqft(totals[('band_revised', project_type, label)],
+                              totals[('band_sqft', project_type, label)]) for label in sqft_labels]
+
+    overlay_values = band_values('Reroof (Overlay)')
+    tear_off_values = band_values('Reroof (Tear-off)')
 
     return proj_labels, proj_values, sqft_labels, overlay_values, tear_off_values
 
 
+@instrumented('second_graph_url')
 def second_graph_url(projects, start_date='2016-01-01'):
     '''
     :param projects: pandas dataframe
     :param start_date: string of datetime
-    :return: second url for graph
+    :return: a chart reference for the second graph (see bpw_charts)
+    '''
+    return second_graph(second_graph_numbers(projects, start_date), project_overlay_tearoff(projects, start_date))
+
+
+def second_graph(status_numbers, cost_numbers):
+    '''
+    :param status_numbers: the tuple from second_graph_numbers
+    :param cost_numbers: the tuple from project_overlay_tearoff
+    :return: a chart reference for the second graph (see bpw_charts)
     '''
-    status_labels, status_counts, total_bought, total_projects = second_graph_numbers(projects, start_date)
+    status_labels, status_counts, total_bought, total_projects = status_numbers
 
-    proj_labels, proj_values, sqft_labels, overlay_values, tear_off_values = project_overlay_tearoff(projects,
-                                                                                                     start_date)
+    proj_labels, proj_values, sqft_labels, overlay_values, tear_off_values = cost_numbers
 
     trace1 = go.Bar(
         y=status_labels,
@@ -424,18 +766,71 @@ def second_graph_url(projects, start_date='2016-01-01'):
 
     fig['layout']['annotations'] += annotations
 
-    return py.plot(fig, auto_open=False, filename='Project Snapshot')
+    return render_chart(fig, 'Project Snapshot')
+
+
+# The numbers in the contract terms notes are the square footage of the project
+SQFT_PATTERN = r'([^\$]\d*[,\.]?\d*[,\.]?\d+)\s*s?q?'
+
+# Parsed square footage of each distinct note seen so far
+_sqft_memo = {}
+SQFT_MEMO_SIZE = 100000
+
+
+def extract_sqft(notes):
+    '''
+    :param notes: a pandas series of contract terms notes
+    :return: a float series with the square footage, NaN for missing or empty notes
+    '''
+
+    # Each distinct note is parsed only once, and only if it hasn't been seen before
+    codes, distinct = pd.factorize(notes)
+    values = pd.Series([_sqft_memo.get(note) for note in distinct], dtype='float64')
+    # Empty notes are remembered as NaN, so what is missing is told by the keys
+    unseen = array([note not in _sqft_memo for note in distinct], dtype=bool)
+    missing = pd.Series(list(distinct), dtype=object)[unseen]
+    if len(missing):
+        parsed = _parse_sqft(missing)
+        values[parsed.index] = parsed
+        if len(_sqft_memo) + len(parsed) > SQFT_MEMO_SIZE:
+            _sqft_memo.clear()
+        _sqft_memo.update(zip(missing, parsed))
+
+    # Missing notes have the code -1, which takes the NaN at the end; a chunk
+    # with only missing notes has no distinct ones to take from otherwise
+    sqft = append(values.values, float('nan')).take(codes)
+    return pd.Series(sqft, index=notes.index)
+
+
+def _parse_sqft(notes):
+    '''
+    :param notes: a pandas series of distinct, non missing notes
+    :return: the vectorized equivalent of add_sqft for each note
+    '''
+    matches = notes.str.extractall(SQFT_PATTERN)[0]
+    # Like float() in add_sqft: drop the separators and surrounding spaces. The
+    # first character can be anything but "$"; add_sqft raises on letters and
+    # punctuation there, here they are skipped.
+    matches = matches.replace(r'[,\.]', '', regex=True).str.strip()
+    matches = matches.replace(r'^[^\d+\-]', '', regex=True)
+    numbers = pd.to_numeric(matches, errors='coerce')
+
+    sqft = numbers.groupby(level=0).sum().reindex(notes.index).fillna(0.0)
+    sqft[notes == ""] = float('nan')
+    return sqft
 
 
 def add_sqft(string):
     '''
+    The reference implementation of extract_sqft for a single note
+
     :param string:
     :return: a float of results
     '''
     if string == "":
         return ""
     else:
-        results = re.findall(r'([^\$]\d*[,\.]?\d*[,\.]?\d+)\s*s?q?', string)
+        results = re.findall(SQFT_PATTERN, string)
         results = [float(result.replace(",", "").replace(".", "")) for result in results]
         results = sum(results)
     return results
\ No newline at end of file
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from collections import Counter
+from contextlib import contextmanager
+
+import pandas as pd
+
+from bpw_schema import EXPORTS, DATE, ExportError, convert, missing_key
+from bpw_graphs import export_totals
+
+# The incremental mode of the dashboard.  For each client and start date the
+# store keeps the running totals of the dashboard (see bpw_aggregate) and the
+# rows they were made from.  An update only brings the rows that are new or
+# changed since the last one: the totals of the stored version of those rows
+# are subtracted, the totals of the new version added, so an update costs time
+# in proportion to the delta, not to the whole history.
+#
+# Rows are matched on the key column of their export (see bpw_schema.EXPORTS).
+# Without it a changed row couldn't be told from a new one and the totals would
+# drift from those of the whole export, so exports without the column are
+# refused.  Rows with an empty key fall back to a hash of the row, so rows sent
+# again are recognised but a changed one counts as a new one.
+
+SCHEMA = ['''
+CREATE TABLE IF NOT EXISTS aggregates (
+    client TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    version TEXT NOT NULL,
+    updated REAL NOT NULL,
+    totals TEXT NOT NULL,
+    PRIMARY KEY (client, start_date)
+)
+''', '''
+CREATE TABLE IF NOT EXISTS rows (
+    client TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    export TEXT NOT NULL,
+    key TEXT NOT NULL,
+    row TEXT NOT NULL,
+    PRIMARY KEY (client, start_date, export, key)
+)
+''']
+
+# Bump this when the totals change meaning; stored totals of another version
+# are rebuilt from the stored rows
+VERSION = '3'
+
+# SQLite limits the number of parameters of a statement
+BATCH = 500
+
+
+def encode_totals(totals):
+    return json.dumps(sorted([list(key), value] for key, value in totals.items()))
+
+
+def decode_totals(payload):
+    return Counter(dict((tuple(key), value) for key, value in json.loads(payload)))
+
+
+def encode_rows(name, frame):
+    '''
+    :param name: which export the frame is
+    :param frame: a pandas dataframe from read_export(with_key=True)
+    :return: a list of (key, row) with each row as JSON, the last one for each key
+    '''
+    columns = EXPORTS[name]['columns']
+    values = []
+    for column, kind in columns.items():
+        present = pd.notnull(frame[column])
+        column_values = frame[column]
+        if kind == DATE:
+            column_values = column_values.dt.strftime('%Y-%m-%d %H:%M:%S')
+        values.append(column_values.astype(object).where(present, None).tolist())
+    rows = [json.dumps(row) for row in zip(*values)]
+
+    keys = [hashlib.sha1(row.encode('utf-8')).hexdigest() for row in rows]
+    if EXPORTS[name]['key'] in frame:
+        # Rows with an empty key keep their hash
+        keys = [row_hash if pd.isnull(key) else u'{}'.format(key).strip()
+                for key, row_hash in zip(frame[EXPORTS[name]['key']].tolist(), keys)]
+    return list(dict(zip(keys, rows)).items())
+
+
+def decode_rows(name, rows):
+    '''
+    :param name: which export the rows are
+    :param rows: rows from encode_rows
+    :return: a pandas dataframe like read_export returns
+    '''
+    columns = list(EXPORTS[name]['columns'])
+    frame = pd.DataFrame([json.loads(row) for row in rows], columns=columns)
+    return convert(name, frame.astype(object))
+
+
+class AggregateStore(object):
+
+    def __init__(self, path):
+        '''
+        :param path: the SQLite database file
+        '''
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with self._connect() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    @contextmanager
+    def _connect(self):
+        # The totals are read and written back in one transaction, taken
+        # immediately so two updates of a client never interleave
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def update(self, client_name, start_date, frames):
+        '''
+        :param client_name: name of the client
+        :param start_date: start date of the report
+        :param frames: a dictionary of the new or changed rows of each export, as dataframes
+            from read_export(with_key=True); missing exports are unchanged
+        :return: a Counter with the totals of the dashboard of the client
+        :raise ExportError: if an export has no key column
+        '''
+        missing = [missing_key(name) for name, frame in frames.items() if EXPORTS[name]['key'] not in frame]
+        if missing:
+            raise ExportError('. '.join(missing))
+        with self._connect() as db:
+            totals = self._totals(db, client_name, start_date)
+            for name, frame in frames.items():
+                if not len(frame):
+                    continue
+                rows = encode_rows(name, frame)
+                old = self._rows(db, client_name, start_date, name, [key for key, _ in rows])
+                if old:
+                    totals.subtract(export_totals(name, decode_rows(name, old), start_date))
+                totals.update(export_totals(name, decode_rows(name, [row for _, row in rows]), start_date))
+                db.executemany('INSERT OR REPLACE INTO rows (client, start_date, export, key, row) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               [(client_name, start_date, name, key, row) for key, row in rows])
+            # Totals that went back to nothing would otherwise show up as empty labels
+            totals = Counter(dict((key, value) for key, value in totals.items() if value))
+            db.execute('INSERT OR REPLACE INTO aggregates (client, start_date, version, updated, totals) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (client_name, start_date, VERSION, time.time(), encode_totals(totals)))
+        return totals
+
+    def _totals(self, db, client_name, start_date):
+        row = db.execute('SELECT version, totals FROM aggregates WHERE client = ? AND start_date = ?',
+                         (client_name, start_date)).fetchone()
+        if row is not None and row[0] == VERSION:
+            return decode_totals(row[1])
+
+        # New client, or totals of an older version: start from the stored rows
+        totals = Counter()
+        for name in EXPORTS:
+            rows = [stored[0] for stored in db.execute(
+                'SELECT row FROM rows WHERE client = ? AND start_date = ? AND export = ?',
+                (client_name, start_date, name))]
+            if rows:
+                totals.update(export_totals(name, decode_rows(name, rows), start_date))
+        return totals
+
+    def _rows(self, db, client_name, start_date, name, keys):
+        rows = []
+        for start in range(0, len(keys), BATCH):
+            batch = keys[start:start + BATCH]
+            rows.extend(stored[0] for stored in db.execute(
+                'SELECT row FROM rows WHERE client = ? AND start_date = ? AND export = ? AND key IN ({})'.format(
+                    ', '.join('?' * len(batch))),
+                [client_name, start_date, name] + batch))
+        return rows
+
+    def forget(self, client_name, start_date=None):
+        '''
+        Drops the stored totals and rows of a client, so the next update starts over
+
+        :param client_name: name of the client
+        :param start_date: only those of this start date
+        '''
+        where, args = 'client = ?', [client_name]
+        if start_date is not None:
+            where, args = where + ' AND start_date = ?', args + [start_date]
+        with self._connect() as db:
+            db.execute('DELETE FROM aggregates WHERE ' + where, args)
+            db.execute('DELETE FROM rows WHERE ' + where, args)
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+# An index of the cost per square foot of the projects of every client, so a
+# dashboard can compare a client with all the others.  For each project type,
+# size band and year (see bpw_aggregate.index_totals) it keeps the sums of the
+# contract amounts and of the square footage over all clients, and how many
+# clients they come from.  The rows for ALL_BANDS and ALL_YEARS hold the same
+# sums over all bands or years, so every lookup is a single primary key read.
+#
+# The part each client contributed is kept as well.  Updating a client takes
+# its old part out of the sums and puts the new one in, so running the same
+# client again never counts its projects twice.  Next to it is the digest of
+# the projects export it was made from, when the caller gives one, so a batch
+# can tell that a client is in the index already (see batch.py).
+
+SCHEMA = ['''
+CREATE TABLE IF NOT EXISTS cost_index (
+    type TEXT NOT NULL,
+    band TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    revised REAL NOT NULL,
+    sqft REAL NOT NULL,
+    clients INTEGER NOT NULL,
+    PRIMARY KEY (type, band, year)
+)
+''', '''
+CREATE TABLE IF NOT EXISTS contributions (
+    client TEXT NOT NULL,
+    type TEXT NOT NULL,
+    band TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    revised REAL NOT NULL,
+    sqft REAL NOT NULL,
+    PRIMARY KEY (client, type, band, year)
+)
+''', '''
+CREATE TABLE IF NOT EXISTS sources (
+    client TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+)
+''']
+
+# The keys of the totals the index is made of, see bpw_aggregate.index_totals
+INDEX_KEYS = ('index_revised', 'index_sqft')
+
+
+def index_parts(totals):
+    '''
+    :param totals: a Counter with index totals, see bpw_aggregate.index_totals
+    :return: a dictionary of (revised, sqft) keyed by (type, band, year)
+    '''
+    parts = {}
+    for key, value in totals.items():
+        if key[0] in INDEX_KEYS:
+            revised, sqft = parts.get(key[1:], (0.0, 0.0))
+            if key[0] == 'index_revised':
+                revised += value
+            else:
+                sqft += value
+            parts[key[1:]] = (revised, sqft)
+    return parts
+
+
+class CostIndex(object):
+
+    def __init__(self, path):
+        '''
+        :param path: the SQLite database file
+        '''
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with self._connect() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    @contextmanager
+    def _connect(self):
+        # Taken immediately so two updates never read the same sums
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def update(self, client_name, totals, digest=None):
+        '''
+        Replaces what the client contributes to the index
+
+        :param client_name: name of the client
+        :param totals: a Counter with the index totals of all the projects of the client
+        :param digest: a digest of the projects export the totals come from, see source_digest
+        '''
+        parts = index_parts(totals)
+        with self._connect() as db:
+            old = dict(((row[0], row[1], row[2]), (row[3], row[4])) for row in db.execute(
+                'SELECT type, band, year, revised, sqft FROM contributions WHERE client = ?', (client_name,)))
+            for key in set(old) | set(parts):
+                old_revised, old_sqft = old.get(key, (0.0, 0.0))
+                new_revised, new_sqft = parts.get(key, (0.0, 0.0))
+                clients = (key in parts) - (key in old)
+                db.execute('INSERT OR IGNORE INTO cost_index (type, band, year, revised, sqft, clients) '
+                           'VALUES (?, ?, ?, 0, 0, 0)', key)
+                db.execute('UPDATE cost_index SET revised = revised + ?, sqft = sqft + ?, clients = clients + ? '
+                           'WHERE type = ? AND band = ? AND year = ?',
+                           (new_revised - old_revised, new_sqft - old_sqft, clients) + key)
+            db.execute('DELETE FROM cost_index WHERE clients <= 0')
+            db.execute('DELETE FROM contributions WHERE client = ?', (client_name,))
+            db.executemany('INSERT INTO contributions (client, type, band, year, revised, sqft) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           [(client_name,) + key + part for key, part in parts.items()])
+            db.execute('DELETE FROM sources WHERE client = ?', (client_name,))
+            if digest is not None:
+                db.execute('INSERT INTO sources (client, digest) VALUES (?, ?)', (client_name, digest))
+
+    def source_digest(self, client_name):
+        '''
+        :param client_name: name of the client
+        :return: the digest given to the last update of the client, or None
+        '''
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            row = db.execute('SELECT digest FROM sources WHERE client = ?', (client_name,)).fetchone()
+        finally:
+            db.close()
+        return None if row is None else row[0]
+
+    def compare(self, client_name, keys):
+        '''
+        :param client_name: name of the client
+        :param keys: a list of (type, band, year), where band may be ALL_BANDS and year ALL_YEARS
+        :return: a dictionary with, for each key where both the client and other clients have
+            projects, the cost per square foot of the client, that of all the other clients
+            and how many other clients there are
+        '''
+        compared = {}
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            for key in keys:
+                own = db.execute('SELECT revised, sqft FROM contributions WHERE client = ? '
+                                 'AND type = ? AND band = ? AND year = ?', (client_name,) + tuple(key)).fetchone()
+                index = db.execute('SELECT revised, sqft, clients FROM cost_index '
+                                   'WHERE type = ? AND band = ? AND year = ?', tuple(key)).fetchone()
+                if own is None or index is None or index[2] < 2:
+                    continue
+                # Everyone else is the index without the client
+                revised, sqft = index[0] - own[0], index[1] - own[1]
+                if own[1] > 0 and sqft > 0:
+                    compared[tuple(key)] = (own[0] / own[1], revised / sqft, index[2] - 1)
+        finally:
+            db.close()
+        return compared
+
+    def forget(self, client_name):
+        '''
+        Takes the client out of the index
+
+        :param client_name: name of the client
+        '''
+        self.update(client_name, {})
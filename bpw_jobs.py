@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+# A small job queue so the upload POST doesn't have to wait for the dashboard.
+# Jobs run on a local thread pool; their state is written to JOB_DIR as JSON so
+# whichever gunicorn worker gets the polling request can answer it.
+#
+# A job goes through these states:
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# A queued or running job older than the TTL was lost, like when the worker
+# running it restarted; it fails with this error type
+LOST = 'JobLost'
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue(object):
+
+    def __init__(self, job_dir, workers=2, ttl=60 * 60):
+        '''
+        :param job_dir: directory where the job states are kept
+        :param workers: number of worker threads
+        :param ttl: seconds a finished job is kept around, and the most a job may wait and run
+        '''
+        self.job_dir = job_dir
+        self.workers = workers
+        self.ttl = ttl
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # The pool is started on first use so it is never inherited across a fork
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+
+    def submit(self, func, *args, **meta):
+        '''
+        :param func: the function to run
+        :param args: its arguments
+        :param meta: JSON serializable values stored along with the job
+        :return: the job id
+        '''
+        if not os.path.isdir(self.job_dir):
+            try:
+                os.makedirs(self.job_dir)
+            except OSError:
+                if not os.path.isdir(self.job_dir):
+                    raise
+        self._prune()
+
+        job_id = uuid.uuid4().hex
+        self._save(job_id, dict(state=QUEUED, meta=meta, created=time.time()))
+        self._get_pool().apply_async(self._run, (job_id, func, args))
+        return job_id
+
+    def status(self, job_id):
+        '''
+        :param job_id: a job id from submit
+        :return: a dictionary with the state, meta, result and error of the job, or None
+        '''
+        if not job_id.isalnum():
+            return None
+        job = self._load(self._path(job_id))
+        if job is not None and job['state'] in (QUEUED, RUNNING) and \
+                time.time() - job.get('started', job['created']) >= self.ttl:
+            job.update(state=FAILED, error='The dashboard was interrupted, please upload the files again',
+                       error_type=LOST, finished=time.time())
+            self._save(job_id, job)
+        return job
+
+    def _load(self, path):
+        try:
+            with open(path) as job_file:
+                return json.load(job_file)
+        except (IOError, ValueError):
+            return None
+
+    def _run(self, job_id, func, args):
+        job = self.status(job_id)
+        if job is None or job['state'] != QUEUED:
+            # Pruned or given up on while it waited
+            logger.warning('Dashboard job %s is gone, not running it', job_id)
+            return
+        job.update(state=RUNNING, started=time.time())
+        self._save(job_id, job)
+        try:
+            result = func(*args)
+        except Exception as error:
+            logger.exception('Dashboard job %s failed', job_id)
+            job.update(state=FAILED, error=str(error), error_type=type(error).__name__, finished=time.time())
+        else:
+            job.update(state=DONE, result=result, finished=time.time())
+        self._save(job_id, job)
+
+    def _path(self, job_id):
+        return os.path.join(self.job_dir, job_id + '.json')
+
+    def _save(self, job_id, job):
+        path = self._path(job_id)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'w') as tmp:
+            json.dump(job, tmp)
+        os.rename(tmp_path, path)
+
+    def _prune(self):
+        # Only finished jobs, someone may still be polling the others; lost ones
+        # are marked failed by status and go a TTL later
+        now = time.time()
+        for name in os.listdir(self.job_dir):
+            path = os.path.join(self.job_dir, name)
+            try:
+                if now - os.path.getmtime(path) < self.ttl:
+                    continue
+                if name.endswith('.json'):
+                    job = self._load(path)
+                    if job is not None and job['state'] not in (DONE, FAILED):
+                        self.status(name[:-len('.json')])
+                        continue
+                os.remove(path)
+            except OSError:
+                continue
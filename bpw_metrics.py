@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import logging
+import threading
+from functools import wraps
+from timeit import default_timer
+
+# Timing and memory instrumentation of the dashboard stages.
+#
+#   with timed('read_csv:roofs'):
+#       ...
+#
+#   @instrumented('upper_right_stats')
+#   def upper_right_stats(...):
+#
+# Each stage is logged as a JSON line on the 'bpw.metrics' logger and counted
+# in a histogram that the app serves in the Prometheus text format on /metrics.
+# The numbers are per process, so each gunicorn worker reports its own.
+# Instrumentation is off until configure(True) is called; when it is off,
+# timed() hands back a shared do-nothing context manager.
+
+logger = logging.getLogger('bpw.metrics')
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_enabled = False
+
+
+def configure(enabled):
+    '''
+    :param enabled: turn the instrumentation on or off
+    '''
+    global _enabled
+    _enabled = bool(enabled)
+
+
+def enabled():
+    return _enabled
+
+
+def rss_bytes():
+    '''
+    :return: the resident memory of this process, or None where it can't be read
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Elsewhere only the peak is available
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Registry(object):
+    '''
+    Counters, gauges and histograms keyed by name and labels
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0, 0.0]
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render(self):
+        '''
+        :return: the metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        with self._lock:
+            for kind, values in [('counter', self._counters), ('gauge', self._gauges)]:
+                for name in sorted(set(key[0] for key in values)):
+                    self._header(lines, name, kind)
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+            for name in sorted(set(key[0] for key in self._histograms)):
+                self._header(lines, name, 'histogram')
+                for (metric, labels), (buckets, count, total) in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket in zip(BUCKETS, buckets):
+                        lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', _number(bound)),)),
+                                                             bucket))
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', '+Inf'),)), count))
+                    lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(total)))
+                    lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append('# HELP {} {}'.format(name, self._help[name]))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, u'{}'.format(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+registry.describe('bpw_stage_seconds', 'Time spent in each dashboard stage.')
+registry.describe('bpw_stage_errors_total', 'Dashboard stages that raised an exception.')
+registry.describe('bpw_stage_rss_delta_bytes', 'Change of the resident memory over the last run of a stage.')
+registry.describe('bpw_process_rss_bytes', 'Resident memory of the worker after the last stage.')
+registry.describe('bpw_cache_requests_total', 'Dashboard cache lookups by result.')
+
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.rss = rss_bytes()
+        self.started = default_timer()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        seconds = default_timer() - self.started
+        rss = rss_bytes()
+        delta = None if rss is None or self.rss is None else rss - self.rss
+        registry.observe('bpw_stage_seconds', seconds, stage=self.name)
+        if kind is not None:
+            registry.inc('bpw_stage_errors_total', stage=self.name)
+        if rss is not None:
+            registry.set('bpw_process_rss_bytes', rss)
+        if delta is not None:
+            registry.set('bpw_stage_rss_delta_bytes', delta, stage=self.name)
+        logger.info(json.dumps(dict(event='stage', stage=self.name, seconds=round(seconds, 6),
+                                    rss_bytes=rss, rss_delta_bytes=delta, failed=kind is not None)))
+        return False
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def timed(name):
+    '''
+    :param name: name of the stage
+    :return: a context manager that records the stage when instrumentation is on
+    '''
+    if not _enabled:
+        return _null_stage
+    return _Stage(name)
+
+
+def instrumented(name):
+    '''
+    :param name: name of the stage
+    :return: a decorator that records every call of the function as that stage
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
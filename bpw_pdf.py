@@ -0,0 +1,300 @@
+import os
+import re
+import time
+import logging
+import threading
+import traceback
+import multiprocessing
+from timeit import default_timer
+
+import bpw_charts
+import bpw_metrics
+from bpw_metrics import timed
+
+# PDF export of the dashboards.  WeasyPrint runs in a pool of worker processes
+# so it never blocks a web worker, and every PDF is kept in PDF_DIR under the
+# id of its dashboard.  The app submits the PDF as soon as a dashboard is
+# computed, so by the time someone presses export it is usually on disk.
+#
+# Each worker process is warmed up when it starts (warm_up): WeasyPrint is
+# imported, the stylesheets are compiled and a small page is laid out so the
+# fonts are found before the first dashboard comes in.  The Bootstrap link of
+# the dashboards is replaced by a compiled copy of the Bootstrap that ships
+# with Flask-Bootstrap, instead of being fetched and parsed for every PDF.
+# The charts are drawn as SVG straight from CHART_DIR, and kept, since a chart
+# id never changes what it draws; anything else fetched over the network is
+# fetched once per process.
+#
+# render_many lays out the dashboards of several clients in one pass and
+# writes them as one PDF, see batch.py --combined.
+#
+# A render that fails in the background is logged and forgotten, so the next
+# request for the PDF renders it again.  One that takes longer than the timeout
+# keeps going, and the request gets PdfUnavailable to try again later.
+
+STYLESHEET = ('@page { size: A3 portrait;'
+              'background-color: #f8f8ff ;'
+              ' margin: 2cm };'
+              '* { float: none !important; };'
+              'body { background: #f8f8ff; }'
+              '@media print { nav { display: none; }'
+              '.piechart{width:200px; }')
+
+CHART_URL = re.compile(r'/charts/([0-9a-f]{40})\.svg$')
+
+BOOTSTRAP_LINK = re.compile(r'<link[^>]+href="[^"]*/bootstrap(?:\.min)?\.css"[^>]*>')
+
+# Exercises the fonts of Bootstrap and of the charts
+WARM_UP_HTML = ('<p style="font-family: Helvetica Neue, Helvetica, Arial, sans-serif">Warm up <b>bold</b> '
+                '<i>italic</i> $1,234.56</p><img src="data:image/svg+xml;charset=utf-8,'
+                '%3Csvg xmlns=%22http://www.w3.org/2000/svg%22 width=%2210%22 height=%2210%22 '
+                'font-family=%22Arial, sans-serif%22%3E%3Ctext y=%229%22%3E1%3C/text%3E%3C/svg%3E">')
+
+# Charts and other fetched resources kept by each worker process
+MEMO_SIZE = 256
+
+logger = logging.getLogger(__name__)
+
+
+class PdfUnavailable(Exception):
+    '''
+    The PDF failed to render or isn't rendered yet
+    '''
+
+# Per worker process state
+_stylesheets = None
+_fetched = {}
+_svgs = {}
+
+
+def _get_stylesheets():
+    global _stylesheets
+    if _stylesheets is None:
+        import flask_bootstrap
+        from weasyprint import CSS
+        bootstrap = os.path.join(os.path.dirname(flask_bootstrap.__file__), 'static', 'css', 'bootstrap.css')
+        _stylesheets = [CSS(filename=bootstrap), CSS(string=STYLESHEET)]
+    return _stylesheets
+
+
+def warm_up():
+    '''
+    Runs once in each worker process, before the first PDF
+    '''
+    try:
+        from weasyprint import HTML
+        HTML(string=WARM_UP_HTML).write_pdf(stylesheets=_get_stylesheets())
+    except Exception:
+        # The first real PDF reports whatever is wrong
+        logger.exception('Could not warm up the PDF renderer')
+
+
+def _url_fetcher(chart_dir, static_dir):
+    from weasyprint import default_url_fetcher
+    try:
+        from urllib.parse import urlparse
+    except ImportError:
+        from urlparse import urlparse
+
+    def fetch(url):
+        path = urlparse(url).path
+        chart = CHART_URL.search(path)
+        if chart:
+            if chart.group(1) not in _svgs:
+                figure = bpw_charts.LocalChartBackend(chart_dir).load(chart.group(1))
+                if len(_svgs) >= MEMO_SIZE:
+                    _svgs.clear()
+                _svgs[chart.group(1)] = bpw_charts.figure_svg(figure).encode('utf-8')
+            return dict(string=_svgs[chart.group(1)], mime_type='image/svg+xml')
+        if static_dir and path.startswith('/static/'):
+            return dict(file_obj=open(os.path.join(static_dir, path[len('/static/'):]), 'rb'))
+        if url not in _fetched:
+            if len(_fetched) >= MEMO_SIZE:
+                _fetched.clear()
+            result = default_url_fetcher(url)
+            if 'file_obj' in result:
+                result['string'] = result.pop('file_obj').read()
+            _fetched[url] = result
+        return dict(_fetched[url])
+    return fetch
+
+
+def render(html, base_url, chart_dir, static_dir=None):
+    '''
+    Runs in the worker processes
+
+    :param html: the rendered dashboard_pdf.html
+    :param base_url: the URL relative links in the HTML are resolved against
+    :param chart_dir: where the local chart backend keeps the figures
+    :param static_dir: the static folder of the app
+    :return: the PDF as bytes
+    '''
+    with timed('render_pdf'):
+        return _layout(html, base_url, _url_fetcher(chart_dir, static_dir)).write_pdf()
+
+
+def render_job(html, base_url, chart_dir, static_dir=None):
+    '''
+    Runs render in the worker processes of PdfRenderer; it never raises, so the
+    callback always hears back (Python 2 has no error callbacks)
+
+    :return: the PDF or None, the seconds it took and the traceback of a failure or None
+    '''
+    started = default_timer()
+    try:
+        return render(html, base_url, chart_dir, static_dir), default_timer() - started, None
+    except Exception:
+        return None, default_timer() - started, traceback.format_exc()
+
+
+def render_many(documents, chart_dir, static_dir=None):
+    '''
+    :param documents: a list of (html, base_url) of rendered dashboard_pdf.html
+    :param chart_dir: where the local chart backend keeps the figures
+    :param static_dir: the static folder of the app
+    :return: one PDF with the pages of all the documents, as bytes
+    '''
+    fetch = _url_fetcher(chart_dir, static_dir)
+    laid_out = [_layout(html, base_url, fetch) for html, base_url in documents]
+    return laid_out[0].copy([page for document in laid_out for page in document.pages]).write_pdf()
+
+
+def _layout(html, base_url, fetch):
+    from weasyprint import HTML
+
+    # The compiled Bootstrap takes the place of the link
+    html = BOOTSTRAP_LINK.sub('', html, count=1)
+    return HTML(string=html, base_url=base_url, url_fetcher=fetch).render(stylesheets=_get_stylesheets())
+
+
+class PdfRenderer(object):
+
+    def __init__(self, pdf_dir, chart_dir, static_dir=None, workers=2, ttl=30 * 24 * 60 * 60, timeout=120):
+        '''
+        :param pdf_dir: directory where the PDFs are kept
+        :param chart_dir: where the local chart backend keeps the figures
+        :param static_dir: the static folder of the app
+        :param workers: number of WeasyPrint processes
+        :param ttl: seconds a PDF is kept
+        :param timeout: seconds to wait for a PDF
+        '''
+        self.pdf_dir = pdf_dir
+        self.chart_dir = chart_dir
+        self.static_dir = static_dir
+        self.workers = workers
+        self.ttl = ttl
+        self.timeout = timeout
+        self._pool = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        '''
+        Starts the worker processes.  A fork copies only the thread that calls it, so
+        this is called before the web worker starts any threads (see gunicorn_config.py),
+        otherwise the pool is started on first use.
+        '''
+        with self._lock:
+            self._get_pool()
+
+    def _get_pool(self):
+        # Called with the lock held; never inherited across a fork since it starts in the web worker
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, initializer=warm_up)
+        return self._pool
+
+    def _path(self, result_id):
+        if not result_id.isalnum():
+            raise KeyError(result_id)
+        return os.path.join(self.pdf_dir, result_id + '.pdf')
+
+    def submit(self, result_id, html, base_url):
+        '''
+        Starts rendering the PDF of a dashboard unless it is already rendered or on its way
+
+        :param result_id: the id of the dashboard in the result store
+        :param html: the rendered dashboard_pdf.html
+        :param base_url: the URL relative links in the HTML are resolved against
+        '''
+        path = self._path(result_id)
+        with self._lock:
+            if result_id in self._pending or os.path.exists(path):
+                return
+            self._pending[result_id] = self._get_pool().apply_async(
+                render_job, (html, base_url, self.chart_dir, self.static_dir),
+                callback=lambda result: self._done(result_id, path, *result))
+
+    def get(self, result_id, html_factory=None):
+        '''
+        :param result_id: the id of the dashboard in the result store
+        :param html_factory: returns (html, base_url) if the PDF has to be rendered now
+        :return: the PDF as bytes, or None if it isn't rendered and there is no html_factory
+        :raise PdfUnavailable: if it isn't rendered within the timeout, or failed twice
+        '''
+        path = self._path(result_id)
+        # A failed render, like one started in the background, is tried once more
+        for _ in range(2):
+            with self._lock:
+                pending = self._pending.get(result_id)
+            if pending is None:
+                try:
+                    with open(path, 'rb') as pdf_file:
+                        return pdf_file.read()
+                except IOError:
+                    if html_factory is None:
+                        return None
+                self.submit(result_id, *html_factory())
+                with self._lock:
+                    pending = self._pending.get(result_id)
+                if pending is None:
+                    # Another thread finished it in the meantime
+                    continue
+
+            try:
+                pdf, _, error = pending.get(self.timeout)
+            except multiprocessing.TimeoutError:
+                # Still rendering, the next request waits for the same render
+                raise PdfUnavailable('The PDF of {} is still being rendered'.format(result_id))
+            if error is None:
+                return pdf
+        raise PdfUnavailable('The PDF of {} could not be rendered'.format(result_id))
+
+    def _done(self, result_id, path, pdf, seconds, error):
+        # Called by the pool once the PDF is rendered or failed
+        if bpw_metrics.enabled():
+            bpw_metrics.registry.observe('bpw_stage_seconds', seconds, stage='render_pdf')
+        if error is not None:
+            logger.error('Could not render the PDF of %s\n%s', result_id, error)
+            with self._lock:
+                self._pending.pop(result_id, None)
+            return
+        self._save(result_id, path, pdf)
+
+    def _save(self, result_id, path, pdf):
+        try:
+            if not os.path.isdir(self.pdf_dir):
+                try:
+                    os.makedirs(self.pdf_dir)
+                except OSError:
+                    if not os.path.isdir(self.pdf_dir):
+                        raise
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as tmp:
+                tmp.write(pdf)
+            os.rename(tmp_path, path)
+            self._prune()
+        except (IOError, OSError):
+            logger.exception('Could not save the PDF of %s', result_id)
+        finally:
+            with self._lock:
+                self._pending.pop(result_id, None)
+
+    def _prune(self):
+        now = time.time()
+        for name in os.listdir(self.pdf_dir):
+            path = os.path.join(self.pdf_dir, name)
+            try:
+                if now - os.path.getmtime(path) >= self.ttl:
+                    os.remove(path)
+            except OSError:
+                continue
@@ -0,0 +1,243 @@
+from collections import OrderedDict
+
+import csv
+
+# The declared schema of the four Dataforma exports.  Only the columns listed
+# here are read from the CSV files, and each one is converted once, right after
+# reading, according to its kind:
+#
+#   category: repeated labels like statuses and subtypes
+#   currency: money amounts that may contain "$" and thousands separators
+#   date:     dates, parsed once per distinct value
+#   text:     free text, kept as strings
+#
+# Money stays float64: the dashboard adds up whole exports of amounts, and
+# float32 would lose the cents of those sums.
+#
+# The key of an export is the column that identifies a row across exports, used
+# by the incremental mode (see bpw_incremental).
+#
+# validate_exports checks the header and the first SAMPLE_ROWS rows of the
+# uploads before anything else is done with them.
+#
+# pandas is imported by the functions that use it, so that the app can import
+# the schema without it (see app.preload).
+
+CATEGORY = 'category'
+CURRENCY = 'currency'
+DATE = 'date'
+TEXT = 'text'
+
+SAMPLE_ROWS = 20
+
+
+class ExportError(ValueError):
+    '''
+    An uploaded file can't be read as the export it was given as
+    '''
+
+EXPORTS = OrderedDict([
+    ('roofs', dict(
+        title='Roof_Condition_Export',
+        key='ROOF ID',
+        columns=OrderedDict([
+            ('Roof Condition', CATEGORY),
+        ]))),
+    ('worders', dict(
+        title='Work_Order_Export',
+        key='WORKORDER #',
+        columns=OrderedDict([
+            ('SUBTYPE', CATEGORY),
+            ('STATUS', CATEGORY),
+            ('FINANCIAL_RESPONSIBILITY', CATEGORY),
+        ]))),
+    ('projects', dict(
+        title='Custom_Project_Export',
+        key='PROJECT #',
+        columns=OrderedDict([
+            ('STATUS', CATEGORY),
+            ('STATUSDATE', DATE),
+            ('BID AMOUNT', CURRENCY),
+            ('REVISEDCONTRACTAMOUNT', CURRENCY),
+            ('CONTRACT TERMS NOTES', TEXT),
+            ('TYPE', CATEGORY),
+        ]))),
+    ('receivables', dict(
+        title='Custom_Accounts_Receivable_Export',
+        key='INVOICE #',
+        columns=OrderedDict([
+            ('INVOICE AMOUNT', CURRENCY),
+            ('WORKORDER SUBTYPE', CATEGORY),
+            ('WORKORDER TYPE', CATEGORY),
+        ]))),
+])
+
+
+def to_currency(values):
+    '''
+    :param values: a pandas series of money amounts
+    :return: the amounts as float64, NaN where they can't be read
+    '''
+    import pandas as pd
+
+    if values.dtype == object:
+        values = values.replace(r'[\$,]', '', regex=True)
+    return pd.to_numeric(values, errors='coerce').astype('float64')
+
+
+def to_dates(values):
+    '''
+    :param values: a pandas series of date strings
+    :return: the dates as datetime64, each distinct string is parsed only once
+    '''
+    import pandas as pd
+
+    distinct = values.dropna().unique()
+    return values.map(pd.Series(pd.to_datetime(distinct), index=distinct))
+
+
+CONVERTERS = {
+    CATEGORY: lambda values: values.astype('category'),
+    CURRENCY: to_currency,
+    DATE: to_dates,
+    TEXT: lambda values: values,
+}
+
+
+def validate_exports(files, with_key=False):
+    '''
+    Reads only the header and the first rows of each file, so a wrong upload is caught in milliseconds
+
+    :param files: a dictionary with the path of the file uploaded for each export
+    :param with_key: the files must also have the key column of their export, see bpw_incremental
+    :raise ExportError: with what is wrong with each file, and what a file in the wrong slot looks like
+    '''
+    import pandas as pd
+
+    samples = {}
+    for name, csv_file in files.items():
+        try:
+            samples[name] = pd.read_csv(csv_file, nrows=SAMPLE_ROWS, dtype=object)
+        except ValueError as error:
+            raise _export_error(name, error)
+
+    problems = []
+    for name in [name for name in EXPORTS if name in samples]:
+        sample = samples[name]
+        title = EXPORTS[name]['title']
+        missing = [column for column in EXPORTS[name]['columns'] if column not in sample]
+        if not missing:
+            problems.extend(_sample_problems(name, sample))
+            if with_key and EXPORTS[name]['key'] not in sample:
+                problems.append(missing_key(name))
+            continue
+        looks_like = [EXPORTS[other]['title'] for other in EXPORTS
+                      if other != name and all(column in sample for column in EXPORTS[other]['columns'])]
+        if looks_like:
+            problems.append('The file uploaded as {} looks like the {} file'.format(title, looks_like[0]))
+        else:
+            problems.append('The {} file has no {} column{}'.format(
+                title, ', '.join('"{}"'.format(column) for column in missing), 's' if len(missing) > 1 else ''))
+    if problems:
+        raise ExportError('. '.join(problems))
+
+
+def missing_key(name):
+    '''
+    :param name: which export this is, one of the keys of EXPORTS
+    :return: the problem of a file of that export without its key column
+    '''
+    return 'The {} file has no "{}" column, which is needed to update a dashboard with only the changed rows'.format(
+        EXPORTS[name]['title'], EXPORTS[name]['key'])
+
+
+def _sample_problems(name, sample):
+    # Money and date columns where none of the sampled values can be read
+    import pandas as pd
+
+    problems = []
+    for column, kind in EXPORTS[name]['columns'].items():
+        values = sample[column].dropna()
+        if not len(values) or kind not in (CURRENCY, DATE):
+            continue
+        if kind == CURRENCY:
+            converted = to_currency(values)
+        else:
+            converted = pd.to_datetime(values, errors='coerce')
+        if converted.isnull().all():
+            problems.append('The "{}" column of the {} file has no {} in its first rows'.format(
+                column, EXPORTS[name]['title'], 'amounts' if kind == CURRENCY else 'dates'))
+    return problems
+
+
+def read_header(csv_file):
+    '''
+    :param csv_file: a path or seekable file object of a CSV export
+    :return: the list of column names, the file object is left where it was
+    '''
+    if not hasattr(csv_file, 'read'):
+        with open(csv_file, 'rb') as opened:
+            return read_header(opened)
+    position = csv_file.tell()
+    try:
+        line = csv_file.readline()
+    finally:
+        csv_file.seek(position)
+    if isinstance(line, bytes) and not isinstance(line, str):
+        line = line.decode('utf-8', 'replace')
+    for row in csv.reader([line]):
+        return row
+    return []
+
+
+def convert(name, frame):
+    '''
+    :param name: which export this is, one of the keys of EXPORTS
+    :param frame: a pandas dataframe with the declared columns
+    :return: the frame, with each declared column converted according to its kind
+    '''
+    for column, kind in EXPORTS[name]['columns'].items():
+        frame[column] = CONVERTERS[kind](frame[column])
+    return frame
+
+
+def read_export(name, csv_file, with_key=False, chunksize=None):
+    '''
+    :param name: which export this is, one of the keys of EXPORTS
+    :param csv_file: a path or file object of the CSV export
+    :param with_key: also read the key column of the export, when the file has one
+    :param chunksize: read the file this many rows at a time
+    :return: a pandas dataframe with only the declared columns, converted, or
+        an iterator of such dataframes when a chunksize is given
+    '''
+    import pandas as pd
+
+    usecols = list(EXPORTS[name]['columns'])
+    if with_key and EXPORTS[name]['key'] in read_header(csv_file):
+        usecols.append(EXPORTS[name]['key'])
+    if chunksize is not None:
+        return _read_chunks(name, csv_file, usecols, chunksize)
+    try:
+        frame = pd.read_csv(csv_file, usecols=usecols,
+                            dtype=dict((column, object) for column in usecols))
+        # A value past the sampled rows, like a date of "TBD", fails here
+        return convert(name, frame)
+    except ValueError as error:
+        raise _export_error(name, error)
+
+
+def _read_chunks(name, csv_file, usecols, chunksize):
+    import pandas as pd
+
+    try:
+        reader = pd.read_csv(csv_file, usecols=usecols, chunksize=chunksize,
+                             dtype=dict((column, object) for column in usecols))
+        for frame in reader:
+            yield convert(name, frame)
+    except ValueError as error:
+        raise _export_error(name, error)
+
+
+def _export_error(name, error):
+    # Missing columns, an empty file and malformed CSV all end up here
+    return ExportError('The {} file could not be read: {}'.format(EXPORTS[name]['title'], error))
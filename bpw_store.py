@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+from contextlib import contextmanager
+
+# Server side storage of computed dashboards.  Each dashboard is kept in a
+# SQLite database under an opaque id, so the dashboard and PDF pages can be
+# shared by URL and the results never travel in the session cookie.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    expires REAL NOT NULL,
+    payload TEXT NOT NULL
+)
+'''
+
+
+class ResultStore(object):
+
+    def __init__(self, path, ttl=30 * 24 * 60 * 60):
+        '''
+        :param path: the SQLite database file
+        :param ttl: seconds a dashboard is kept
+        '''
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with self._connect() as db:
+            db.execute(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # One connection per call keeps the store safe to use from the job threads
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def put(self, dash_list, client_name, start_date):
+        '''
+        :param dash_list: the list from bpw_graphs.dashboard
+        :param client_name: name of the client
+        :param start_date: start date of the report
+        :return: the id of the stored dashboard
+        '''
+        result_id = uuid.uuid4().hex
+        now = time.time()
+        payload = json.dumps(dict(dash_list=dash_list, client_name=client_name, start_date=start_date))
+        with self._connect() as db:
+            db.execute('DELETE FROM results WHERE expires < ?', (now,))
+            db.execute('INSERT INTO results (id, created, expires, payload) VALUES (?, ?, ?, ?)',
+                       (result_id, now, now + self.ttl, payload))
+        return result_id
+
+    def get(self, result_id):
+        '''
+        :param result_id: an id from put
+        :return: a dictionary with dash_list, client_name, start_date and created, or None
+        '''
+        with self._connect() as db:
+            row = db.execute('SELECT created, payload FROM results WHERE id = ? AND expires >= ?',
+                             (result_id, time.time())).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[1])
+        result['created'] = row[0]
+        return result
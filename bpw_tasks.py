@@ -0,0 +1,159 @@
+import json
+import atexit
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
+
+import bpw_metrics
+
+# Runs the stages of a dashboard as a small dependency graph.
+#
+#   with TaskGraph('dashboard') as graph:
+#       graph.add('roofs', read_export, args=('roofs', path))
+#       graph.add('conditions', count_conditions, 'roofs')
+#       graph.add('pie_chart', pie_chart, 'conditions', unpack=True, process=True)
+#   chart = graph.get('pie_chart')
+#
+# Each task runs on a thread of its graph once the tasks it depends on are
+# done, with their results as its first arguments.  pandas lets go of the GIL
+# while it parses a CSV file and in most of its aggregations, so those overlap
+# on threads.  Building a plotly figure is plain Python, so the tasks added
+# with process=True run on a pool of PROCESSES processes shared by all the
+# graphs of this process.  Their arguments and results are pickled, so only
+# small values like the numbers of a chart go there; dataframes stay on the
+# threads.
+#
+# The threads take the tasks in the order they were added and a task only
+# waits for tasks added before it, so a graph never deadlocks however few
+# threads it has.
+#
+# With instrumentation on (see bpw_metrics) each graph reports its critical
+# path when it is closed: the chain of tasks the last one to finish waited
+# on.  Its length is the latency of the graph, the sum of all the tasks is what
+# it would take one after another.
+
+_threads = 4
+_processes = 0
+_pool = None
+_pool_lock = threading.Lock()
+
+bpw_metrics.registry.describe('bpw_critical_path_seconds', 'Latency of each task graph, see bpw_tasks.')
+bpw_metrics.registry.describe('bpw_serial_seconds', 'Time the tasks of each graph would take one after another.')
+
+
+def configure(threads=4, processes=0):
+    '''
+    :param threads: number of threads of each graph
+    :param processes: number of processes for the tasks added with process=True,
+        0 to run them on the threads
+    '''
+    global _threads, _processes
+    _threads = max(1, threads)
+    _processes = processes
+
+
+def start():
+    '''
+    Starts the processes.  A fork copies only the thread that calls it, so this is
+    called before the web worker starts any threads (see gunicorn_config.py),
+    otherwise the pool is started by the first graph.
+    '''
+    get_process_pool()
+
+
+def get_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None and _processes > 0:
+            _pool = multiprocessing.Pool(_processes)
+            atexit.register(_pool.terminate)
+        return _pool
+
+
+class TaskGraph(object):
+
+    def __init__(self, name):
+        '''
+        :param name: name of the graph in the metrics
+        '''
+        self.name = name
+        # Shared by the graphs; started by start() before any threads, or here on first use
+        self._processes = get_process_pool()
+        self._pool = ThreadPool(_threads)
+        self._tasks = {}
+        self._after = {}
+        self._times = {}
+        self.started = default_timer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        self.close()
+        return False
+
+    def add(self, name, func, *after, **options):
+        '''
+        :param name: name of the task
+        :param func: the function to run
+        :param after: names of the tasks whose results are the first arguments of func
+        :param options: args, more arguments of func after those;
+            unpack, pass each result of after as several arguments;
+            process, run func on the process pool
+        '''
+        self._after[name] = after
+        self._tasks[name] = self._pool.apply_async(self._run, (name, func, after, options))
+
+    def _run(self, name, func, after, options):
+        args = []
+        for dependency in after:
+            result = self._tasks[dependency].get()
+            args.extend(result if options.get('unpack') else [result])
+        args.extend(options.get('args', ()))
+        started = default_timer()
+        try:
+            if options.get('process') and self._processes is not None:
+                return self._processes.apply(func, args)
+            return func(*args)
+        finally:
+            self._times[name] = (started, default_timer())
+
+    def get(self, name):
+        '''
+        :param name: name of a task
+        :return: its result, raises what it raised
+        '''
+        return self._tasks[name].get()
+
+    def close(self):
+        '''
+        Waits for all the tasks, and reports the critical path when instrumentation is on
+        '''
+        self._pool.close()
+        self._pool.join()
+        if bpw_metrics.enabled():
+            seconds, path = self.critical_path()
+            serial = sum(finished - started for started, finished in self._times.values())
+            bpw_metrics.registry.observe('bpw_critical_path_seconds', seconds, graph=self.name)
+            bpw_metrics.registry.observe('bpw_serial_seconds', serial, graph=self.name)
+            bpw_metrics.logger.info(json.dumps(dict(
+                event='critical_path', graph=self.name, seconds=round(seconds, 6), serial_seconds=round(serial, 6),
+                path=[[task, round(task_seconds, 6)] for task, task_seconds in path])))
+
+    def critical_path(self):
+        '''
+        :return: the seconds from the start of the graph to the end of its last task, and
+            the chain of tasks that one waited on as a list of (task, seconds) in order
+        '''
+        if not self._times:
+            return 0.0, []
+        name = max(self._times, key=lambda task: self._times[task][1])
+        seconds = self._times[name][1] - self.started
+        path = []
+        while name is not None:
+            started, finished = self._times[name]
+            path.append((name, finished - started))
+            done = [dependency for dependency in self._after[name] if dependency in self._times]
+            name = max(done, key=lambda dependency: self._times[dependency][1]) if done else None
+        return seconds, path[::-1]
@@ -7,6 +7,42 @@ class Config(object):
     TESTING = False
     CSRF_ENABLED = True
     SECRET_KEY = os.environ['BPW_DASH_SECRET_KEY']
+    # 'local' renders the charts on this server, 'plotly' uploads them to the Plotly cloud
+    CHART_BACKEND = os.environ.get('BPW_CHART_BACKEND', 'local')
+    CHART_DIR = os.environ.get('BPW_CHART_DIR', os.path.join(basedir, 'charts'))
+    # Dashboard results cache, see bpw_cache
+    CACHE_DIR = os.environ.get('BPW_CACHE_DIR', os.path.join(basedir, 'cache'))
+    CACHE_MAX_ENTRIES = int(os.environ.get('BPW_CACHE_MAX_ENTRIES', 128))
+    CACHE_MAX_DISK_ENTRIES = int(os.environ.get('BPW_CACHE_MAX_DISK_ENTRIES', 1024))
+    CACHE_TTL = int(os.environ.get('BPW_CACHE_TTL', 24 * 60 * 60))
+    # Dashboard jobs, see bpw_jobs
+    JOB_DIR = os.environ.get('BPW_JOB_DIR', os.path.join(basedir, 'jobs'))
+    JOB_WORKERS = int(os.environ.get('BPW_JOB_WORKERS', 2))
+    # Computed dashboards, see bpw_store
+    RESULT_DB = os.environ.get('BPW_RESULT_DB', os.path.join(basedir, 'results', 'results.db'))
+    RESULT_TTL = int(os.environ.get('BPW_RESULT_TTL', 30 * 24 * 60 * 60))
+    # Parsed exports of each client, see bpw_columns
+    COLUMN_DIR = os.environ.get('BPW_COLUMN_DIR', os.path.join(basedir, 'columns'))
+    # Uploads are kept on disk until their job ran; MAX_CONTENT_LENGTH caps a request
+    MAX_CONTENT_LENGTH = int(os.environ.get('BPW_MAX_UPLOAD_MB', 1024)) * 1000 * 1000
+    UPLOAD_DIR = os.environ.get('BPW_UPLOAD_DIR', os.path.join(basedir, 'uploads'))
+    UPLOAD_TTL = int(os.environ.get('BPW_UPLOAD_TTL', 24 * 60 * 60))
+    # Uploads larger than this in total are read CHUNK_ROWS rows at a time
+    CHUNKED_MIN_BYTES = int(os.environ.get('BPW_CHUNKED_MIN_MB', 100)) * 1000 * 1000
+    CHUNK_ROWS = int(os.environ.get('BPW_CHUNK_ROWS', 100000))
+    # Running totals of the incremental dashboards, see bpw_incremental
+    INCREMENTAL_DB = os.environ.get('BPW_INCREMENTAL_DB', os.path.join(basedir, 'results', 'incremental.db'))
+    # Cost per square foot of all clients, see bpw_index
+    COST_INDEX_DB = os.environ.get('BPW_COST_INDEX_DB', os.path.join(basedir, 'results', 'cost_index.db'))
+    # PDF exports of the dashboards, see bpw_pdf
+    PDF_DIR = os.environ.get('BPW_PDF_DIR', os.path.join(basedir, 'pdfs'))
+    PDF_WORKERS = int(os.environ.get('BPW_PDF_WORKERS', 2))
+    PDF_TIMEOUT = int(os.environ.get('BPW_PDF_TIMEOUT', 120))
+    # Threads of each dashboard, and processes that draw the charts (0 to draw them on the threads), see bpw_tasks
+    DASHBOARD_THREADS = int(os.environ.get('BPW_DASHBOARD_THREADS', 4))
+    CHART_PROCESSES = int(os.environ.get('BPW_CHART_PROCESSES', 0))
+    # Stage timings in the logs and on /metrics, see bpw_metrics
+    METRICS_ENABLED = os.environ.get('BPW_METRICS_ENABLED', '0') == '1'
 
 
 class ProductionConfig(Config):
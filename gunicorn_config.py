@@ -0,0 +1,30 @@
+import os
+
+# Settings for gunicorn, see the Procfile.  With BPW_PRELOAD=1 the app is loaded
+# in the master, which then imports pandas, plotly and WeasyPrint (app.preload)
+# before it forks, so every worker starts warm and shares those pages with the
+# others copy on write.  Without it each worker imports them on first use.
+# Changed code needs a restart of the master rather than a HUP when preloading.
+#
+# The PDF and chart processes are forked from each worker before it starts any
+# threads, so they can't inherit a lock another thread was holding.
+
+preload_app = os.environ.get('BPW_PRELOAD', '0') == '1'
+
+
+def when_ready(server):
+    # Runs in the master once the app is loaded and before the workers start
+    if preload_app:
+        import app
+        app.preload()
+        server.log.info('Preloaded the dashboard modules')
+
+
+def post_worker_init(worker):
+    # Runs in each worker once the app is loaded and before it serves anything
+    import app
+    import bpw_tasks
+    # The chart processes fork once the PDF pool runs its handler threads, which only
+    # hold the locks of that pool's queues; the chart processes never use those
+    app.pdfs.start()
+    bpw_tasks.start()
@@ -0,0 +1,84 @@
+import os
+import io
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from werkzeug.http import http_date
+
+# The app is configured from the environment when it is imported
+TMP_DIR = tempfile.mkdtemp(prefix='bpw-test-api-')
+os.environ.setdefault('APP_SETTINGS', 'config.TestingConfig')
+os.environ.setdefault('BPW_DASH_SECRET_KEY', 'test')
+for setting, name in [('BPW_CHART_DIR', 'charts'), ('BPW_CACHE_DIR', 'cache'), ('BPW_JOB_DIR', 'jobs'),
+                      ('BPW_RESULT_DB', 'results.db'), ('BPW_COLUMN_DIR', 'columns'), ('BPW_UPLOAD_DIR', 'uploads'),
+                      ('BPW_INCREMENTAL_DB', 'incremental.db'), ('BPW_COST_INDEX_DB', 'cost_index.db'),
+                      ('BPW_PDF_DIR', 'pdfs')]:
+    os.environ[setting] = os.path.join(TMP_DIR, name)
+
+import app
+import bpw_graphs
+from benchmarks.generate import generate
+
+START_DATE = '01/01/2016'
+
+
+def tearDownModule():
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+class DashboardApiTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        paths = generate(os.path.join(TMP_DIR, 'exports'), 500)
+        dash_list = bpw_graphs.dashboard(*([paths[name] for name in ['roofs', 'worders', 'projects', 'receivables']] +
+                                           [START_DATE]))
+        cls.result_id = app.results.put(dash_list + [None], 'Acme', START_DATE)
+        # Only the numbers, small enough to be sent as is
+        cls.small_id = app.results.put([None] * len(bpw_graphs.DASH_FIELDS), 'Acme', START_DATE)
+
+    def setUp(self):
+        self.client = app.app.test_client()
+
+    def get(self, result_id, **headers):
+        return self.client.get('/api/dashboard/{}'.format(result_id), headers=headers)
+
+    def test_not_modified_for_a_matching_etag(self):
+        response = self.get(self.result_id)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        again = self.get(self.result_id, **{'If-None-Match': etag})
+        self.assertEqual((again.status_code, again.get_data(), again.headers['ETag']), (304, b'', etag))
+        self.assertEqual(self.get(self.result_id, **{'If-None-Match': '"other"'}).status_code, 200)
+
+    def test_not_modified_since_it_was_stored(self):
+        last_modified = self.get(self.result_id).headers['Last-Modified']
+        self.assertEqual(self.get(self.result_id, **{'If-Modified-Since': last_modified}).status_code, 304)
+        before = datetime.utcnow() - timedelta(days=1)
+        self.assertEqual(self.get(self.result_id, **{'If-Modified-Since': http_date(before)}).status_code, 200)
+
+    def test_missing_dashboard_is_not_answered_with_a_304(self):
+        response = self.get('missing', **{'If-None-Match': '"missing-{}"'.format(app.API_VERSION)})
+        self.assertEqual(response.status_code, 404)
+
+    def test_gzips_large_responses(self):
+        plain = self.get(self.result_id)
+        self.assertGreater(len(plain.get_data()), app.GZIP_MIN_BYTES)
+        self.assertIsNone(plain.content_encoding)
+
+        compressed = self.get(self.result_id, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed.content_encoding, 'gzip')
+        body = gzip.GzipFile(fileobj=io.BytesIO(compressed.get_data())).read()
+        self.assertEqual(json.loads(body.decode('utf-8')), json.loads(plain.get_data(as_text=True)))
+
+        small = self.get(self.small_id, **{'Accept-Encoding': 'gzip'})
+        self.assertLessEqual(len(small.get_data()), app.GZIP_MIN_BYTES)
+        self.assertIsNone(small.content_encoding)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bpw_charts
+import bpw_graphs
+import bpw_tasks
+from benchmarks.generate import generate
+
+NAMES = ['roofs', 'worders', 'projects', 'receivables']
+
+# Not a divisor of any export's length, so the last chunk is a short one
+CHUNKSIZE = 997
+
+
+class ChunkedDashboardTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix='bpw-test-chunks-')
+        paths = generate(os.path.join(cls.tmp_dir, 'exports'), 5000, seed=3)
+        cls.files = [paths[name] for name in NAMES]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.backend = bpw_charts._backend
+        bpw_charts.configure('local', os.path.join(self.tmp_dir, 'charts'))
+        bpw_tasks.configure(threads=4, processes=0)
+        bpw_graphs._sqft_memo.clear()
+
+    def tearDown(self):
+        bpw_charts._backend = self.backend
+        bpw_graphs._sqft_memo.clear()
+
+    def test_matches_the_full_frames(self):
+        for start_date in ['01/01/2014', '06/01/2016']:
+            full = bpw_graphs.dashboard(*(self.files + [start_date]))
+            chunked = bpw_graphs.dashboard(*(self.files + [start_date]), chunksize=CHUNKSIZE)
+            self.assertEqual(chunked, full, start_date)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import bpw_columns
+import bpw_graphs
+from bpw_columns import ColumnStore, SQFT, NOTES, client_dir
+from bpw_schema import read_export
+from benchmarks.generate import generate
+
+NAMES = ['roofs', 'worders', 'projects', 'receivables']
+
+
+class ColumnStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='bpw-test-columns-')
+        self.paths = generate(os.path.join(self.tmp_dir, 'exports'), 1000)
+        self.column_dir = os.path.join(self.tmp_dir, 'columns')
+        self.format_version = bpw_columns.FORMAT_VERSION
+        bpw_graphs._sqft_memo.clear()
+
+        # Counts the exports read from their CSV file instead of the store
+        self.parsed = []
+
+        def counted(name, *args, **kwargs):
+            self.parsed.append(name)
+            return read_export(name, *args, **kwargs)
+        bpw_columns.read_export = counted
+
+    def tearDown(self):
+        bpw_columns.read_export = read_export
+        bpw_columns.FORMAT_VERSION = self.format_version
+        bpw_graphs._sqft_memo.clear()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def load(self, name):
+        return ColumnStore(self.column_dir).load('Acme Co.', name, self.paths[name])
+
+    def test_round_trip(self):
+        for name in NAMES:
+            expected = read_export(name, self.paths[name])
+            if name == 'projects':
+                expected[SQFT] = bpw_graphs.extract_sqft(expected[NOTES])
+                del expected[NOTES]
+            written = self.load(name)
+            loaded = self.load(name)
+            self.assertEqual(list(loaded.columns), list(expected.columns))
+            for frame in (written, loaded):
+                for column in expected:
+                    self.assertTrue(frame[column].equals(expected[column]), '{} {}'.format(name, column))
+        self.assertEqual(self.parsed, NAMES)
+
+    def test_rebuilt_when_the_cleaning_code_changes(self):
+        self.load('projects')
+        bpw_columns.FORMAT_VERSION = self.format_version + '-changed'
+        self.load('projects')
+        self.load('projects')
+        self.assertEqual(self.parsed, ['projects', 'projects'])
+        with open(os.path.join(self.column_dir, client_dir('Acme Co.'), 'projects', 'meta.json')) as meta_file:
+            self.assertEqual(json.load(meta_file)['version'], bpw_columns.cleaning_version())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+import bpw_charts
+import bpw_graphs
+import bpw_tasks
+from bpw_incremental import AggregateStore
+from benchmarks.generate import generate
+
+START_DATE = '01/01/2015'
+NAMES = ['roofs', 'worders', 'projects', 'receivables']
+
+# Rows of the first upload that come back changed in the second one
+CHANGED = 50
+
+
+def change(name, frame):
+    # What a later export has for rows the client updated meanwhile
+    frame = frame.copy()
+    if name == 'roofs':
+        frame['Roof Condition'] = 'Excellent'
+    elif name == 'worders':
+        frame['STATUS'] = 'COMPLETED'
+    elif name == 'projects':
+        frame['STATUS'] = '(8) COMPLETED'
+    else:
+        frame['INVOICE AMOUNT'] = '100.00'
+    return frame
+
+
+class IncrementalDashboardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='bpw-test-incremental-')
+        self.backend = bpw_charts._backend
+        bpw_charts.configure('local', os.path.join(self.tmp_dir, 'charts'))
+        bpw_tasks.configure(threads=4, processes=0)
+        bpw_graphs._sqft_memo.clear()
+        paths = generate(os.path.join(self.tmp_dir, 'exports'), 2000, seed=1)
+        self.frames = dict((name, pd.read_csv(paths[name], dtype=object)) for name in NAMES)
+        self.store = AggregateStore(os.path.join(self.tmp_dir, 'aggregates.db'))
+
+    def tearDown(self):
+        bpw_charts._backend = self.backend
+        bpw_graphs._sqft_memo.clear()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def write(self, label, frames):
+        paths = []
+        for name in NAMES:
+            if frames.get(name) is None:
+                paths.append(None)
+                continue
+            path = os.path.join(self.tmp_dir, '{}-{}.csv'.format(label, name))
+            frames[name].to_csv(path, index=False)
+            paths.append(path)
+        return paths
+
+    def test_deltas_add_up_to_the_full_exports(self):
+        first, second, final = {}, {}, {}
+        for name, frame in self.frames.items():
+            half = len(frame) // 2
+            changed = change(name, frame.iloc[:CHANGED])
+            first[name] = frame.iloc[:half]
+            second[name] = pd.concat([frame.iloc[half:], changed])
+            final[name] = pd.concat([changed, frame.iloc[CHANGED:]])
+
+        bpw_graphs.dashboard(*(self.write('first', first) + [START_DATE, self.store, 'Acme']))
+        # Only the exports that changed are sent, in two uploads
+        bpw_graphs.dashboard(*(self.write('second', dict(roofs=second['roofs'], worders=second['worders'])) +
+                               [START_DATE, self.store, 'Acme']))
+        incremental = bpw_graphs.dashboard(*(self.write('third', dict(projects=second['projects'],
+                                                                      receivables=second['receivables'])) +
+                                             [START_DATE, self.store, 'Acme']))
+
+        full = bpw_graphs.dashboard(*(self.write('final', final) + [START_DATE]))
+        self.assertEqual(incremental, full)
+
+    def test_rows_sent_again_are_not_counted_twice(self):
+        paths = self.write('full', self.frames)
+        once = bpw_graphs.dashboard(*(paths + [START_DATE, self.store, 'Acme']))
+        twice = bpw_graphs.dashboard(*(paths + [START_DATE, self.store, 'Acme']))
+        self.assertEqual(once, twice)
+        self.assertEqual(once, bpw_graphs.dashboard(*(paths + [START_DATE])))
+
+
+if __name__ == '__main__':
+    unittest.main()
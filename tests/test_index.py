@@ -0,0 +1,61 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from collections import Counter
+
+from bpw_index import CostIndex
+
+KEY = ('Reroof (Tear-off)', '10k-25k', 2015)
+
+
+def totals(revised, sqft, key=KEY):
+    return Counter({('index_revised',) + key: revised, ('index_sqft',) + key: sqft})
+
+
+class CostIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='bpw-test-index-')
+        self.path = os.path.join(self.tmp_dir, 'cost_index.db')
+        self.index = CostIndex(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def sums(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute('SELECT type, band, year, revised, sqft, clients FROM cost_index').fetchall()
+        finally:
+            db.close()
+
+    def test_same_client_twice_is_counted_once(self):
+        self.index.update('Acme', totals(60000.0, 12000.0))
+        self.index.update('Acme', totals(60000.0, 12000.0))
+        self.assertEqual(self.sums(), [KEY + (60000.0, 12000.0, 1)])
+
+    def test_update_replaces_what_the_client_had(self):
+        self.index.update('Acme', totals(60000.0, 12000.0))
+        self.index.update('Beta', totals(20000.0, 10000.0))
+        self.index.update('Acme', totals(30000.0, 10000.0, key=KEY[:2] + (2016,)))
+        self.assertEqual(sorted(self.sums()), [KEY + (20000.0, 10000.0, 1), KEY[:2] + (2016, 30000.0, 10000.0, 1)])
+
+    def test_compares_with_the_other_clients(self):
+        self.index.update('Acme', totals(60000.0, 12000.0))
+        self.index.update('Beta', totals(20000.0, 10000.0))
+        self.index.update('Beta', totals(20000.0, 10000.0))
+        self.assertEqual(self.index.compare('Acme', [KEY]), {KEY: (5.0, 2.0, 1)})
+        self.index.forget('Beta')
+        self.assertEqual(self.index.compare('Acme', [KEY]), {})
+
+    def test_keeps_the_digest_of_the_last_update(self):
+        self.index.update('Acme', totals(60000.0, 12000.0), digest='abc')
+        self.assertEqual(self.index.source_digest('Acme'), 'abc')
+        self.index.update('Acme', totals(60000.0, 12000.0))
+        self.assertIsNone(self.index.source_digest('Acme'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from bpw_jobs import JobQueue, QUEUED, RUNNING, DONE, FAILED, LOST
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp(prefix='bpw-test-jobs-')
+        self.jobs = JobQueue(self.job_dir, workers=1, ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+    def age(self, job_id, seconds):
+        # Jobs of another worker, from before it restarted
+        job = self.jobs.status(job_id)
+        for field in ('created', 'started'):
+            if field in job:
+                job[field] -= seconds
+        self.jobs._save(job_id, job)
+        then = time.time() - seconds
+        os.utime(self.jobs._path(job_id), (then, then))
+
+    def test_runs_a_job(self):
+        job_id = self.jobs.submit(lambda value: value * 2, 21, client_name='Acme')
+        for _ in range(100):
+            if self.jobs.status(job_id)['state'] == DONE:
+                break
+            time.sleep(0.01)
+        job = self.jobs.status(job_id)
+        self.assertEqual((job['state'], job['result'], job['meta']), (DONE, 42, dict(client_name='Acme')))
+
+    def test_prune_keeps_unfinished_jobs(self):
+        for job_id, state in [('queued', QUEUED), ('running', RUNNING), ('done', DONE), ('failed', FAILED)]:
+            self.jobs._save(job_id, dict(state=state, meta={}, created=time.time(), started=time.time()))
+            self.age(job_id, 30)
+            then = time.time() - 120
+            os.utime(self.jobs._path(job_id), (then, then))
+        self.jobs._prune()
+        self.assertEqual(sorted(os.listdir(self.job_dir)), ['queued.json', 'running.json'])
+
+    def test_lost_jobs_fail(self):
+        self.jobs._save('lost', dict(state=RUNNING, meta={}, created=time.time(), started=time.time()))
+        self.assertEqual(self.jobs.status('lost')['state'], RUNNING)
+        self.age('lost', 120)
+        job = self.jobs.status('lost')
+        self.assertEqual((job['state'], job['error_type']), (FAILED, LOST))
+
+    def test_run_of_a_pruned_job_returns(self):
+        self.assertIsNone(self.jobs._run('gone', lambda: self.fail('ran a pruned job'), ()))
+        self.assertIsNone(self.jobs.status('gone'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import bpw_charts
+import bpw_graphs
+import bpw_tasks
+from benchmarks.generate import generate
+from benchmarks.run import DEFAULT_MEMORY_BUDGET, MEMORY_ALLOWANCE, START_DATE
+
+# Large enough that the frames, not plotly, take most of the memory
+ROWS = 20000
+
+
+@unittest.skipIf(tracemalloc is None, 'tracemalloc needs Python 3')
+class DashboardMemoryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix='bpw-test-data-')
+        cls.chart_dir = tempfile.mkdtemp(prefix='bpw-test-charts-')
+        paths = generate(cls.data_dir, ROWS)
+        cls.files = [paths[name] for name in ['roofs', 'worders', 'projects', 'receivables']]
+        cls.input_bytes = sum(os.path.getsize(path) for path in cls.files)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+        shutil.rmtree(cls.chart_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.backend = bpw_charts._backend
+        bpw_charts.configure('local', self.chart_dir)
+        bpw_tasks.configure(threads=4, processes=0)
+        bpw_graphs._sqft_memo.clear()
+
+    def tearDown(self):
+        bpw_charts._backend = self.backend
+        bpw_graphs._sqft_memo.clear()
+
+    def test_dashboard_peak_within_budget(self):
+        tracemalloc.start()
+        try:
+            bpw_graphs.dashboard(*(self.files + [START_DATE]))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        limit = DEFAULT_MEMORY_BUDGET * self.input_bytes + MEMORY_ALLOWANCE
+        self.assertLessEqual(peak, limit, 'dashboard peaked at {:,.1f} MB, over the budget of {:,.1f} MB'.format(
+            peak / 1e6, limit / 1e6))
+
+
+if __name__ == '__main__':
+    unittest.main()
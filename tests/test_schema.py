@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from bpw_schema import EXPORTS, ExportError, validate_exports
+from benchmarks.generate import generate
+
+
+class ValidateExportsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='bpw-test-schema-')
+        self.paths = generate(self.tmp_dir, 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def assertRefused(self, files, message, **kwargs):
+        with self.assertRaises(ExportError) as raised:
+            validate_exports(files, **kwargs)
+        self.assertIn(message, str(raised.exception))
+
+    def test_accepts_the_exports(self):
+        validate_exports(self.paths)
+        validate_exports(self.paths, with_key=True)
+
+    def test_refuses_swapped_files(self):
+        files = dict(self.paths, worders=self.paths['receivables'], receivables=self.paths['worders'])
+        self.assertRefused(files, 'The file uploaded as Work_Order_Export looks like the '
+                                  'Custom_Accounts_Receivable_Export file')
+        self.assertRefused(files, 'The file uploaded as Custom_Accounts_Receivable_Export looks like the '
+                                  'Work_Order_Export file')
+
+    def test_refuses_a_missing_key_column(self):
+        key = EXPORTS['projects']['key']
+        path = os.path.join(self.tmp_dir, 'no-key.csv')
+        frame = pd.read_csv(self.paths['projects'], dtype=object)
+        del frame[key]
+        frame.to_csv(path, index=False)
+
+        # Only the incremental mode needs it
+        validate_exports(dict(self.paths, projects=path))
+        self.assertRefused(dict(projects=path), '"{}"'.format(key), with_key=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
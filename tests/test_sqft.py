@@ -0,0 +1,80 @@
+import math
+import unittest
+
+import pandas as pd
+
+import bpw_graphs
+from bpw_graphs import add_sqft, extract_sqft
+
+# Contract terms notes and what add_sqft makes of them
+GOLDEN = [
+    "Standard terms apply",
+    "12,500 sq ft",
+    "12500 sqft",
+    " 8.000 sq",
+    "$45,000 contract, 20,000 sq ft",
+    "1.500",
+    "1,500",
+    "R-30 insulation over 15000 sq",
+    "Two roofs: 3,000 and 4,500 sq ft",
+    "Roof A-12,500",
+    "12,000 sq ft.",
+    "$",
+    "7",
+]
+
+# Notes where add_sqft raises on the character before the number, which
+# extract_sqft skips instead
+RAISING = [
+    ("Area:12,000", 12000.0),
+    ("x12,000 sq", 12000.0),
+    ("(12,000 sf)", 12000.0),
+]
+
+
+class ExtractSqftTest(unittest.TestCase):
+
+    def setUp(self):
+        bpw_graphs._sqft_memo.clear()
+
+    def tearDown(self):
+        bpw_graphs._sqft_memo.clear()
+
+    def test_matches_add_sqft(self):
+        sqft = extract_sqft(pd.Series(GOLDEN))
+        for note, value in zip(GOLDEN, sqft):
+            self.assertEqual(value, add_sqft(note), note)
+
+    def test_missing_and_empty_notes(self):
+        self.assertEqual(add_sqft(""), "")
+        self.assertRaises(TypeError, add_sqft, None)
+        sqft = extract_sqft(pd.Series(["", None, "12,500 sq ft"]))
+        self.assertTrue(math.isnan(sqft[0]))
+        self.assertTrue(math.isnan(sqft[1]))
+        self.assertEqual(sqft[2], 12500.0)
+        self.assertTrue(extract_sqft(pd.Series([None, None], dtype=object)).isnull().all())
+
+    def test_skips_what_add_sqft_raises_on(self):
+        for note, expected in RAISING:
+            self.assertRaises(ValueError, add_sqft, note)
+        sqft = extract_sqft(pd.Series([note for note, _ in RAISING]))
+        self.assertEqual(list(sqft), [expected for _, expected in RAISING])
+
+    def test_second_call_is_served_from_the_memo(self):
+        notes = pd.Series(GOLDEN + [note for note, _ in RAISING] + ["", None])
+        first = extract_sqft(notes)
+
+        def parse(notes):
+            raise AssertionError('parsed again: {!r}'.format(list(notes)))
+
+        parse_sqft = bpw_graphs._parse_sqft
+        bpw_graphs._parse_sqft = parse
+        try:
+            second = extract_sqft(notes)
+        finally:
+            bpw_graphs._parse_sqft = parse_sqft
+        self.assertTrue(first.equals(second))
+
+
+if __name__ == '__main__':
+    unittest.main()